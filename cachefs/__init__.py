@@ -6,8 +6,9 @@
 # vim: set ts=4 sts=4 et tw=78 sw=4 si:
 
 from .cachefs import CacheFs
+from .match import Match
 
-__all__ = ['CacheFs']
+__all__ = ['CacheFs', 'Match']
 
 __author__ = 'VRT Systems'
 __copyright__ = 'Copyright 2016, VRT Systems'
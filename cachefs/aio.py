@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Cached file-system utility library
+# (C) 2016 VRT Systems
+#
+# vim: set ts=4 sts=4 et tw=78 sw=4 si:
+
+"""
+asyncio interface to the cache.  This requires Python 3.5 or later, and so is
+not imported by the cachefs package itself.
+
+Data already held in the cache is returned directly; anything that needs I/O
+is fetched in an executor so that the event loop is not blocked, with
+concurrent requests for the same data sharing the one fetch.
+"""
+
+import asyncio
+import os
+
+from .cachefs import CacheFs
+
+
+class AsyncCacheFs(object):
+    '''
+    An asyncio facade over a CacheFs instance.  Paths are looked up and
+    queried with coroutines; executor is the concurrent.futures executor used
+    for I/O (by default, that of the event loop).
+    '''
+
+    # Number of results fetched per trip to the executor by find().
+    FIND_BATCH = 100
+
+    def __init__(self, cache, executor=None):
+        if not isinstance(cache, CacheFs):
+            raise TypeError('%r is not a CacheFs instance' % cache)
+        self._cache = cache
+        self._executor = executor
+
+        # In-flight fetches, by (operation, path).
+        self._inflight = {}
+
+    @property
+    def cache(self):
+        '''
+        Return the underlying CacheFs instance.
+        '''
+        return self._cache
+
+    def _call(self, key, fn):
+        '''
+        Run fn in the executor, or join the run already in flight for key.
+        '''
+        future = self._inflight.get(key)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            future = loop.run_in_executor(self._executor, fn)
+            self._inflight[key] = future
+            future.add_done_callback(
+                    lambda f : self._inflight.pop(key, None))
+        # Don't let one waiter's cancellation cancel the others.
+        return asyncio.shield(future)
+
+    async def node(self, path):
+        '''
+        Return the filesystem node for the named path.  Raises KeyError if
+        the path does not exist.
+        '''
+        abs_path = os.path.abspath(path)
+        cache = self._cache
+        cache._scheduler.poll()
+        node = cache._nodes.get(abs_path)
+        if node is not None:
+            cache.stats.incr('hits')
+            node._update_atime()
+            return node
+        return await self._call(('node', abs_path),
+                lambda : self._cache[abs_path])
+
+    async def stat(self, path):
+        '''
+        Return the result of os.lstat() on the named path.
+        '''
+        node = await self.node(path)
+        st = node._node.peek_stat(self._cache._required_time)
+        if st is not None:
+            node._update_atime()
+            return st
+        return await self._call(('stat', node.abs_path),
+                lambda : node.stat)
+
+    async def listdir(self, path):
+        '''
+        Return the set of names in the named directory.
+        '''
+        node = await self.node(path)
+        children = node._node.peek_children(self._cache._required_time)
+        if children is not None:
+            node._update_atime()
+            return children.copy()
+        return await self._call(('listdir', node.abs_path),
+                lambda : set(node))
+
+    async def target(self, path):
+        '''
+        Return the target of the named symbolic link.
+        '''
+        node = await self.node(path)
+        target = node._node.peek_target(self._cache._required_time)
+        if target is not None:
+            node._update_atime()
+            return target
+        return await self._call(('target', node.abs_path),
+                lambda : node.target)
+
+    def find(self, *args, **kwargs):
+        '''
+        Search for nodes, as per CacheFs.find, returning an asynchronous
+        iterator over the results.
+        '''
+        return _AsyncFind(self, self._cache.find(*args, **kwargs))
+
+
+class _AsyncFind(object):
+    '''
+    Asynchronous iterator over the results of a search.  The search runs in
+    the executor, a batch of results at a time.
+    '''
+
+    def __init__(self, afs, results):
+        self._afs = afs
+        self._results = results
+        self._batch = []
+        self._done = False
+
+    def _next_batch(self):
+        batch = []
+        for found in self._results:
+            batch.append(found)
+            if len(batch) >= self._afs.FIND_BATCH:
+                break
+        return batch
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._batch:
+            if self._done:
+                raise StopAsyncIteration
+            loop = asyncio.get_event_loop()
+            batch = await loop.run_in_executor(self._afs._executor,
+                    self._next_batch)
+            if len(batch) < self._afs.FIND_BATCH:
+                self._done = True
+            if not batch:
+                raise StopAsyncIteration
+            batch.reverse()
+            self._batch = batch
+        return self._batch.pop()
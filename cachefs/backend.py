@@ -0,0 +1,376 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Cached file-system utility library
+# (C) 2016 VRT Systems
+#
+# vim: set ts=4 sts=4 et tw=78 sw=4 si:
+
+"""
+File system back-ends.  A back-end makes the file system calls on behalf of
+the cache, and holds the registry of back-end nodes for that file system,
+which is shared by all caches using it.
+
+LocalBackend is the local file system, via the os module; it is the default.
+MemoryBackend is a file system held in memory, with optional latency added to
+each call to stand in for a slow or remote store.
+"""
+
+import errno
+import itertools
+import os
+import stat
+import threading
+import time
+import weakref
+
+try:
+    from os import scandir
+except ImportError:  # pragma: no cover
+    # Python < 3.5, try the back-port.
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+class Backend(object):
+    '''
+    The interface to a file system.  The methods mirror those of the os
+    module, raising OSError on failure.  Sub-classes must call
+    Backend.__init__, which sets up the registry of back-end nodes.
+    '''
+
+    # Whether scandir() is supported; if not, listdir() is used instead.
+    SCANDIR = True
+
+    # Whether entries returned by scandir() carry their statistics for free.
+    ENTRY_HAS_STAT = False
+
+    # The registry of nodes is split into this many shards, selected by the
+    # hash of the path, each with its own lock.
+    _SHARDS = 64
+
+    def __init__(self):
+        self._nodes = tuple(weakref.WeakValueDictionary()
+                for n in range(self._SHARDS))
+        self._nodes_lk = tuple(threading.Lock()
+                for n in range(self._SHARDS))
+
+    def lstat(self, path):  # pragma: no cover
+        '''
+        Return the statistics for path, not following symbolic links.
+        '''
+        raise NotImplementedError()
+
+    def scandir(self, path):  # pragma: no cover
+        '''
+        Return an iterable of entries (as per os.scandir) for the directory.
+        '''
+        raise NotImplementedError()
+
+    def listdir(self, path):
+        '''
+        Return a list of the names in the directory.
+        '''
+        return [entry.name for entry in self.scandir(path)]
+
+    def readlink(self, path):  # pragma: no cover
+        '''
+        Return the target of a symbolic link.
+        '''
+        raise NotImplementedError()
+
+    def realpath(self, path):  # pragma: no cover
+        '''
+        Return the canonical path, with symbolic links resolved.
+        '''
+        raise NotImplementedError()
+
+
+class LocalBackend(Backend):
+    '''
+    The local file system.
+    '''
+
+    SCANDIR = (scandir is not None)
+
+    # Directory entries carry a full stat result on Windows for free;
+    # elsewhere only the file type is known without an extra system call.
+    ENTRY_HAS_STAT = (os.name == 'nt')
+
+    def lstat(self, path):
+        return os.lstat(path)
+
+    def scandir(self, path):
+        return scandir(path)
+
+    def listdir(self, path):
+        return os.listdir(path)
+
+    def readlink(self, path):
+        return os.readlink(path)
+
+    def realpath(self, path):
+        return os.path.realpath(path)
+
+
+class MemoryBackend(Backend):
+    '''
+    A file system held in memory, holding only an empty root directory to
+    start with.  It is populated with mkdir(), write() and symlink(), and
+    changed with those and remove(); times are updated as they would be on
+    disk.  Paths are absolute.
+
+    If latency is given, each call made by the cache first sleeps that many
+    seconds, so this may stand in for a remote store.
+    '''
+
+    ENTRY_HAS_STAT = True
+
+    # Symbolic links followed whilst resolving a path before giving up.
+    MAX_LINKS = 40
+
+    def __init__(self, latency=0.0):
+        super(MemoryBackend, self).__init__()
+        self.latency = latency
+        self._lock = threading.Lock()
+        self._inodes = itertools.count(1)
+        self._files = {os.sep: self._new(stat.S_IFDIR | 0o755)}
+
+    # File system calls
+
+    def lstat(self, path):
+        self._wait()
+        with self._lock:
+            return self._get(path).stat()
+
+    def scandir(self, path):
+        self._wait()
+        with self._lock:
+            directory = self._get_dir(path)
+            return [_MemoryEntry(self, os.path.join(path, name),
+                    name, self._files[os.path.join(directory.path, name)])
+                for name in sorted(directory.children)]
+
+    def listdir(self, path):
+        self._wait()
+        with self._lock:
+            return sorted(self._get_dir(path).children)
+
+    def readlink(self, path):
+        self._wait()
+        with self._lock:
+            target = self._get(path).target
+        if target is None:
+            raise _error(errno.EINVAL, path)
+        return target
+
+    def realpath(self, path):
+        self._wait()
+        with self._lock:
+            return self._realpath(path)
+
+    # Changes
+
+    def mkdir(self, path, mode=0o755):
+        '''
+        Create a directory.
+        '''
+        self._add(path, stat.S_IFDIR | mode)
+
+    def write(self, path, data=b'', mode=0o644):
+        '''
+        Create or replace a regular file, holding "data" (of which only the
+        size is kept).
+        '''
+        with self._lock:
+            existing = self._find(path)
+            if existing is not None:
+                if not stat.S_ISREG(existing.mode):
+                    raise _error(errno.EISDIR if existing.children is not None
+                            else errno.EEXIST, path)
+                existing.size = len(data)
+                existing.touch()
+                return
+        self._add(path, stat.S_IFREG | mode, size=len(data))
+
+    def symlink(self, target, path):
+        '''
+        Create a symbolic link, pointing to target.
+        '''
+        self._add(path, stat.S_IFLNK | 0o777, target=target)
+
+    def remove(self, path):
+        '''
+        Remove a file, symbolic link or empty directory.
+        '''
+        with self._lock:
+            (parent, name) = self._parent(path)
+            abs_path = os.path.join(parent.path, name)
+            node = self._files.get(abs_path)
+            if node is None:
+                raise _error(errno.ENOENT, path)
+            elif node.children:
+                raise _error(errno.ENOTEMPTY, path)
+            del self._files[abs_path]
+            parent.children.discard(name)
+            parent.touch()
+
+    # Internals; the caller must hold _lock.
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _new(self, mode, size=0, target=None, path=os.sep):
+        return _MemoryFile(path, mode, next(self._inodes), size, target)
+
+    def _add(self, path, mode, size=0, target=None):
+        with self._lock:
+            (parent, name) = self._parent(path)
+            abs_path = os.path.join(parent.path, name)
+            if abs_path in self._files:
+                raise _error(errno.EEXIST, path)
+            self._files[abs_path] = self._new(mode, size, target, abs_path)
+            parent.children.add(name)
+            parent.touch()
+
+    def _parent(self, path):
+        '''
+        Return the (resolved) parent directory of path, and the base name.
+        '''
+        (dir_name, name) = os.path.split(path)
+        if not name:
+            raise _error(errno.EEXIST, path)
+        return (self._get_dir(self._realpath(dir_name)), name)
+
+    def _find(self, path):
+        '''
+        Return the file at path, without following a symbolic link at the
+        end, or None if there is none.
+        '''
+        node = self._files.get(path)
+        if (node is None) and (path != os.sep):
+            (dir_name, name) = os.path.split(path)
+            node = self._files.get(os.path.join(
+                self._realpath(dir_name), name))
+        return node
+
+    def _get(self, path):
+        node = self._find(path)
+        if node is None:
+            raise _error(errno.ENOENT, path)
+        return node
+
+    def _get_dir(self, path):
+        node = self._files.get(self._realpath(path))
+        if node is None:
+            raise _error(errno.ENOENT, path)
+        elif node.children is None:
+            raise _error(errno.ENOTDIR, path)
+        return node
+
+    def _realpath(self, path):
+        resolved = os.sep
+        rest = path.split(os.sep)
+        links = 0
+        while rest:
+            name = rest.pop(0)
+            if (not name) or (name == os.curdir):
+                continue
+            elif name == os.pardir:
+                resolved = os.path.dirname(resolved)
+                continue
+
+            new_path = os.path.join(resolved, name)
+            node = self._files.get(new_path)
+            if (node is None) or (node.target is None):
+                resolved = new_path
+                continue
+
+            links += 1
+            if links > self.MAX_LINKS:
+                # Symbolic link loop; leave the rest unresolved.
+                return os.path.join(new_path, *rest)
+            if os.path.isabs(node.target):
+                resolved = os.sep
+            rest = node.target.split(os.sep) + rest
+        return resolved
+
+
+class _MemoryFile(object):
+    '''
+    A file in a MemoryBackend.
+    '''
+    __slots__ = ('path', 'mode', 'ino', 'size', 'target', 'children',
+            'mtime_ns', 'ctime_ns')
+
+    def __init__(self, path, mode, ino, size, target):
+        self.path = path
+        self.mode = mode
+        self.ino = ino
+        self.size = size
+        self.target = target
+        self.children = set() if stat.S_ISDIR(mode) else None
+        self.touch()
+
+    def touch(self):
+        self.mtime_ns = self.ctime_ns = int(time.time() * 1e9)
+
+    def stat(self):
+        return os.stat_result((self.mode, self.ino, 0,
+            2 if self.children is not None else 1, 0, 0, self.size,
+            self.mtime_ns // 1000000000, self.mtime_ns // 1000000000,
+            self.ctime_ns // 1000000000), {
+                'st_atime':     self.mtime_ns / 1e9,
+                'st_mtime':     self.mtime_ns / 1e9,
+                'st_ctime':     self.ctime_ns / 1e9,
+                'st_atime_ns':  self.mtime_ns,
+                'st_mtime_ns':  self.mtime_ns,
+                'st_ctime_ns':  self.ctime_ns,
+            })
+
+
+class _MemoryEntry(object):
+    '''
+    A directory entry returned by MemoryBackend.scandir(), as per those from
+    os.scandir().
+    '''
+    __slots__ = ('_backend', 'path', 'name', '_stat')
+
+    def __init__(self, backend, path, name, node):
+        self._backend = backend
+        self.path = path
+        self.name = name
+        self._stat = node.stat()
+
+    def stat(self, follow_symlinks=True):
+        if follow_symlinks and stat.S_ISLNK(self._stat.st_mode):
+            return self._backend.lstat(self._backend.realpath(self.path))
+        return self._stat
+
+    def inode(self):
+        return self._stat.st_ino
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self._stat.st_mode)
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_file(self, follow_symlinks=True):
+        try:
+            return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+
+def _error(err, path):
+    return OSError(err, os.strerror(err), path)
+
+
+# The local file system, used by default.
+_LOCAL = LocalBackend()
@@ -23,27 +23,107 @@ but you know you'll be needing to refer back to this information a lot.
 import time
 import os
 import weakref
+import heapq
+import threading
+import sys
+import collections
+import stat
 
 from .node import Node
+from .intnode import _Node, _change_key
+from .stats import Stats
+from .watcher import Watcher
+from .trace import Tracer
+from .backend import Backend, _LOCAL
+from . import snapshot
 from pyat.base import TaskScheduler
 from pyat.sync import SynchronousTaskScheduler
 
+try:
+    from concurrent import futures
+except ImportError:  # pragma: no cover
+    # Python 2 without the 'futures' back-port.
+    futures = None
+
+try:
+    _string_types = basestring
+except NameError:
+    _string_types = str
+
+# Paths looked up by each task in CacheFs.stat_many.
+_STAT_CHUNK = 64
+
 class CacheFs(object):
     '''
     A cached filesystem instance.  This holds strong references to nodes that
     are being frequently accessed by the end user.
+
+    If validate_listing is set, directory listings that have expired are
+    checked against the directory's modification time and only re-read if
+    the directory has changed.
+
+    If a watcher (see cachefs.watcher) is given, nodes it is able to watch
+    are trusted until it reports a change, rather than expiring after
+    stat_expiry seconds.
+
+    The cache may be bounded by max_nodes (a count of nodes) and/or
+    max_bytes (an estimate of memory used by the nodes), in which case the
+    least recently used nodes are evicted to stay within the limits.
+
+    If negative_expiry is given, paths found not to exist are remembered for
+    that many seconds, or until the parent directory is seen to change.
+
+    The stats attribute (a cachefs.stats.Stats instance) counts hits, misses,
+    evictions and purges, and times the file system calls made for this
+    cache.  registry_stats does the same for all caches in the process, and
+    counts the back-end nodes created.
+
+    If a tracer (see cachefs.trace) is given, it is told of each file system
+    call made for this cache.
+
+    backend (see cachefs.backend) is the file system to cache; by default,
+    the local file system.  Caches using the same back-end share the data
+    retrieved.
     '''
 
-    def __init__(self, cache_expiry, stat_expiry, scheduler=None):
+    # Process-wide statistics
+    registry_stats = _Node.stats
+
+    def __init__(self, cache_expiry, stat_expiry, scheduler=None,
+            validate_listing=False, watcher=None, max_nodes=None,
+            max_bytes=None, negative_expiry=None, tracer=None, backend=None):
         # node cache expiry
         self._cache_expiry = float(cache_expiry)
 
         # stat() expiry duration
         self._stat_expiry = float(stat_expiry)
 
+        # Whether to validate expired listings using the modification time
+        self._validate_listing = bool(validate_listing)
+
         # Active nodes.
         self._nodes = {}
 
+        # Heap of (atime, abs_path) for active nodes.  Access times are not
+        # updated in place; stale entries are corrected when popped.
+        self._expiry = []
+        self._expiry_lk = threading.Lock()
+
+        # Capacity limits, and estimated size of active nodes.
+        if (max_nodes is not None) and (max_nodes < 1):
+            raise ValueError('max_nodes must be at least 1')
+        self._max_nodes = max_nodes
+        self._max_bytes = max_bytes
+        self._bytes = 0
+
+        # Paths known not to exist: abs_path -> (expiry time, change key of
+        # the parent directory or None), oldest first.
+        if negative_expiry is not None:
+            negative_expiry = float(negative_expiry)
+        self._negative_expiry = negative_expiry
+        self._negative = collections.OrderedDict()
+        self._negative_lk = threading.Lock()
+
         # Scheduler instance.
         if scheduler is None:
             scheduler = SynchronousTaskScheduler()
@@ -52,28 +132,120 @@ class CacheFs(object):
         self._scheduler = scheduler
         self._purge_task = None
 
+        # File system back-end
+        if backend is None:
+            backend = _LOCAL
+        elif not isinstance(backend, Backend):
+            raise TypeError('%r is not a Backend instance' % backend)
+        self._backend = backend
+
+        # File system change watcher
+        if (watcher is not None) and not isinstance(watcher, Watcher):
+            raise TypeError('%r is not a Watcher instance' % watcher)
+        elif (watcher is not None) and (backend is not _LOCAL):
+            raise ValueError('Watchers only support the default back-end')
+        self._watcher = watcher
+
+        # Back-end nodes holding listings loaded from a snapshot, by path,
+        # until looked up or purged, and when they were loaded.
+        self._loaded = {}
+        self._loaded_time = 0.0
+
+        # Statistics for this cache
+        self.stats = Stats()
+
+        # File system call tracer
+        if (tracer is not None) and not isinstance(tracer, Tracer):
+            raise TypeError('%r is not a Tracer instance' % tracer)
+        self._tracer = tracer
+
     @property
     def _required_time(self):
         return time.time() - self._stat_expiry
 
     @property
     def _min_atime(self):
-        return min([node._atime for node in self._nodes.values()])
+        '''
+        Return the earliest access time of any active node.  This may be
+        earlier than the true value if that node has since been accessed.
+        '''
+        with self._expiry_lk:
+            return self._expiry[0][0]
+
+    @property
+    def _over_capacity(self):
+        return ((self._max_nodes is not None) \
+                    and (len(self._nodes) > self._max_nodes)) \
+                or ((self._max_bytes is not None) \
+                    and (self._bytes > self._max_bytes))
+
+    def _pop_oldest(self, before=None):
+        '''
+        Pop the least recently used node off the expiry heap, and return its
+        path.  If "before" is given, only a node last accessed before then is
+        popped.  Returns None if there is no such node.  The caller must hold
+        _expiry_lk.
+        '''
+        while self._expiry:
+            (atime, abs_path) = self._expiry[0]
+            if (before is not None) and (atime >= before):
+                return None
+
+            heapq.heappop(self._expiry)
+            node = self._nodes.get(abs_path)
+            if node is None:
+                # Already removed.
+                continue
+            elif node._atime > atime:
+                # Accessed since this entry was added, re-file it.
+                heapq.heappush(self._expiry, (node._atime, abs_path))
+                continue
+            return abs_path
+        return None
+
+    def _discard(self, abs_path):
+        '''
+        Drop the named node from the active nodes.
+        '''
+        try:
+            node = self._nodes.pop(abs_path)
+        except KeyError:  # pragma: no cover
+            # Could happen in multi-threadded case, but harmless since
+            # we're deleting anyway.
+            return
+        self._bytes -= node._size
+        if self._watcher is not None:
+            self._watcher.unwatch(node._node)
+
+    def _evict(self):
+        '''
+        Evict the least recently used nodes until within capacity limits.
+        '''
+        with self._expiry_lk:
+            while (len(self._nodes) > 1) and self._over_capacity:
+                abs_path = self._pop_oldest()
+                if abs_path is None:  # pragma: no cover
+                    break
+                self._discard(abs_path)
+                self.stats.incr('evicted')
 
     def _purge(self):
         '''
         Purge the cache of old entries.
         '''
-        all_nodes = list(self._nodes.values())
-        expired = list(filter(lambda n : n.atime_since > self._cache_expiry,
-            all_nodes))
-        for n in expired:
-            try:
-                del self._nodes[n.abs_path]
-            except KeyError:  # pragma: no cover
-                # Could happen in multi-threadded case, but harmless since
-                # we're deleting anyway.
-                pass
+        threshold = time.time() - self._cache_expiry
+        purged = 0
+        with self._expiry_lk:
+            while True:
+                abs_path = self._pop_oldest(threshold)
+                if abs_path is None:
+                    break
+                self._discard(abs_path)
+                purged += 1
+        if self._loaded and (self._loaded_time < threshold):
+            self._loaded = {}
+        self.stats.incr('purges')
+        self.stats.incr('purged', purged)
         if bool(self._nodes):
             self._purge_task = weakref.ref(self._scheduler.schedule(
                     self._min_atime + self._cache_expiry,
@@ -82,29 +254,208 @@ class CacheFs(object):
         else:
             self._purge_task = None
 
+    def _exists(self, node):
+        '''
+        Return True if the given back-end node exists.  This is answered from
+        the parent directory's listing if that is fresh, otherwise by
+        retrieving (and so caching) the node's statistics.
+        '''
+        since_time = self._required_time
+        if node.base_name:
+            parent = _Node.find_node(node.dir_name, self._backend)
+            if parent is not None:
+                children = parent.peek_children(since_time)
+                if children is not None:
+                    return node.base_name in children
+
+        try:
+            node.get_stat(since_time, self)
+            return True
+        except OSError:
+            return False
+
+    def _add_negative(self, node):
+        '''
+        Remember that the given back-end node does not exist.
+        '''
+        if self._negative_expiry is None:
+            return
+
+        now = time.time()
+        parent_key = None
+        parent = _Node.find_node(node.dir_name, self._backend)
+        if parent is not None:
+            st = parent.peek_stat(now - self._stat_expiry)
+            if st is not None:
+                parent_key = _change_key(st)
+
+        with self._negative_lk:
+            # Drop entries that have expired; these are the oldest.
+            while self._negative:
+                (abs_path, (expires, _)) = next(iter(self._negative.items()))
+                if expires > now:
+                    break
+                del self._negative[abs_path]
+
+            self._negative.pop(node.abs_path, None)
+            self._negative[node.abs_path] = \
+                    (now + self._negative_expiry, parent_key)
+
+    def _is_negative(self, abs_path):
+        '''
+        Return True if the named path is remembered as not existing, and the
+        parent directory has not been seen to change since.  A current
+        listing of the parent directory is believed over both.
+        '''
+        if not self._negative:
+            return False
+
+        with self._negative_lk:
+            try:
+                (expires, parent_key) = self._negative[abs_path]
+            except KeyError:
+                return False
+
+        if expires > time.time():
+            since_time = self._required_time
+            (dir_name, base_name) = os.path.split(abs_path)
+            parent = _Node.find_node(dir_name, self._backend)
+            children = None
+            if (parent is not None) and base_name:
+                children = parent.peek_children(since_time)
+            if children is not None:
+                if base_name not in children:
+                    return True
+            elif parent_key is None:
+                return True
+            else:
+                st = None
+                if parent is not None:
+                    st = parent.peek_stat(since_time)
+                if (st is None) or (_change_key(st) == parent_key):
+                    return True
+
+        with self._negative_lk:
+            self._negative.pop(abs_path, None)
+        return False
+
     def __getitem__(self, key):
         '''
         Return the filesystem node that corresponds to the named path.
         '''
         self._scheduler.poll()
-        abs_path = os.path.abspath(key)
+        return self._get_node(os.path.abspath(key), key)
+
+    def _get_node(self, abs_path, key):
+        '''
+        Return the node for a normalised absolute path, raising
+        KeyError(key) if it does not exist.  The scheduler is not polled.
+        '''
         try:
             node = self._nodes[abs_path]
         except KeyError:
+            self.stats.incr('misses')
+            if self._is_negative(abs_path):
+                self.stats.incr('negative_hits')
+                raise KeyError(key)
+
             # No existing node, ensure it exists
-            if not os.path.lexists(abs_path):
+            node = Node(self, abs_path)
+            if not self._exists(node._node):
                 # Path does not exist.
+                self.stats.incr('not_found')
+                self._add_negative(node._node)
                 raise KeyError(key)
-            node = Node(self, abs_path)
-            self._nodes[abs_path] = node
-            if (self._purge_task is None) or (self._purge_task() is None):
-                self._purge_task = weakref.ref(self._scheduler.schedule(
-                        self._min_atime + self._cache_expiry,
-                        self._purge))
+            node = self._add_node(node)
+        else:
+            self.stats.incr('hits')
 
         node._update_atime()
         return node
 
+    def _add_node(self, node):
+        '''
+        Add a new node to the active nodes, evicting others if over capacity
+        and scheduling the purge of expired nodes.  If another thread added a
+        node for the same path first, that node is returned instead;
+        otherwise, the given node is returned.
+        '''
+        node._size = _estimate_size(node)
+        with self._expiry_lk:
+            existing = self._nodes.setdefault(node.abs_path, node)
+            if existing is not node:
+                return existing
+            heapq.heappush(self._expiry, (node._atime, node.abs_path))
+            self._bytes += node._size
+        if self._loaded:
+            # The node now holds its back-end node.
+            self._loaded.pop(node.abs_path, None)
+        if self._over_capacity:
+            self._evict()
+        if self._watcher is not None:
+            self._watcher.watch(node._node)
+        if (self._purge_task is None) or (self._purge_task() is None):
+            self._purge_task = weakref.ref(self._scheduler.schedule(
+                    self._min_atime + self._cache_expiry,
+                    self._purge))
+        return node
+
+    def _realpath(self, abs_path):
+        '''
+        Return the canonical path for abs_path, as per os.path.realpath, but
+        resolving each component through the cache so that cached
+        statistics and link targets are re-used.
+        '''
+        if os.name != 'posix':  # pragma: no cover
+            return self._backend.realpath(abs_path)
+        return self._join_realpath(os.sep, abs_path, {},
+                self._required_time)[0]
+
+    def _join_realpath(self, path, rest, seen, since_time):
+        '''
+        Join "rest" onto the resolved path "path", resolving symbolic links.
+        Returns the path and False if a link loop was found.  "seen" maps
+        link paths to their resolved paths (or None whilst resolving).
+        '''
+        if os.path.isabs(rest):
+            rest = rest[1:]
+            path = os.sep
+
+        while rest:
+            (name, _, rest) = rest.partition(os.sep)
+            if (not name) or (name == os.curdir):
+                continue
+            elif name == os.pardir:
+                path = os.path.dirname(path)
+                continue
+
+            new_path = os.path.join(path, name)
+            try:
+                node = self._get_node(new_path, new_path)._node
+                is_link = (node.get_file_type(since_time, self) \
+                        == stat.S_IFLNK)
+            except (KeyError, OSError):
+                is_link = False
+
+            if not is_link:
+                path = new_path
+                continue
+
+            if new_path in seen:
+                path = seen[new_path]
+                if path is not None:
+                    continue
+                # Symbolic link loop.
+                return (_join_rest(new_path, rest), False)
+
+            seen[new_path] = None
+            (path, ok) = self._join_realpath(path,
+                    node.get_target(since_time, self), seen, since_time)
+            if not ok:
+                return (_join_rest(path, rest), False)
+            seen[new_path] = path
+        return (path, True)
+
     def find(self, *args, **kwargs):
         '''
         Attempt to find nodes that match the given predicate.  The depth
@@ -113,7 +464,273 @@ class CacheFs(object):
 
         Each node is passed to the function called predicate which returns
         True or False.  If it returns True, find yields that node.
+
+        The remaining keyword arguments (such as workers) are as for
+        Node.find.
         '''
         for directory in args:
             for found in self[directory].find(**kwargs):
                 yield found
+
+    def prefetch(self, paths, recursive=True, workers=None, progress=None,
+            timeout=None):
+        '''
+        Warm the cache for the named paths: fetch their statistics, link
+        targets and, for directories, the listing and the statistics of
+        each child.  If recursive is set, sub-directories are warmed too
+        (symbolic links to directories are not followed).  Paths that do
+        not exist are skipped.
+
+        If workers is given, directories are warmed concurrently by a pool
+        of that many threads.  If progress is given, it is called with each
+        directory once warmed, and the number of nodes fetched so far.  If
+        timeout is given, no further directories are started once that many
+        seconds have passed.  Without concurrent.futures (the futures
+        package, on Python 2), workers raises ImportError.
+
+        Returns the number of nodes fetched.
+        '''
+        if isinstance(paths, _string_types):
+            paths = [paths]
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        dirs = []
+        count = 0
+        for path in paths:
+            try:
+                node = self[path]
+            except KeyError:
+                continue
+            file_type = _prefetch_node(node)
+            count += 1
+            if file_type == stat.S_IFDIR:
+                dirs.append(node)
+
+        if workers is None:
+            while dirs and ((deadline is None) or (time.time() < deadline)):
+                node = dirs.pop()
+                (fetched, subdirs) = _prefetch_dir(node, recursive)
+                count += fetched
+                dirs.extend(reversed(subdirs))
+                if progress is not None:
+                    progress(node, count)
+            return count
+
+        if futures is None:  # pragma: no cover
+            raise ImportError('workers require the futures package')
+
+        executor = futures.ThreadPoolExecutor(max_workers=workers)
+        pending = {}
+        try:
+            if (deadline is None) or (time.time() < deadline):
+                for node in dirs:
+                    pending[executor.submit(_prefetch_dir, node,
+                        recursive)] = node
+            while pending:
+                wait_time = None
+                if deadline is not None:
+                    wait_time = max(deadline - time.time(), 0)
+                (done, _) = futures.wait(pending, timeout=wait_time,
+                        return_when=futures.FIRST_COMPLETED)
+                if not done:
+                    # Out of time.
+                    break
+
+                for future in done:
+                    node = pending.pop(future)
+                    (fetched, subdirs) = future.result()
+                    count += fetched
+                    if (deadline is None) or (time.time() < deadline):
+                        for subdir in subdirs:
+                            pending[executor.submit(_prefetch_dir,
+                                subdir, recursive)] = subdir
+                    if progress is not None:
+                        progress(node, count)
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+        return count
+
+    def stat_many(self, paths, workers=None):
+        '''
+        Return the statistics (as per Node.stat) of each of the named
+        paths, as a dict keyed by path.  Paths that do not exist map to
+        None.
+
+        Paths are grouped by their parent directory.  Statistics and
+        listings already cached are used first; the remaining paths are
+        looked up a directory at a time.  Where the back-end's listings
+        carry statistics, a directory holding several of the paths is
+        listed once rather than each path being looked up.
+
+        If workers is given, the look-ups are made concurrently by a pool
+        of that many threads.  Without concurrent.futures (the futures
+        package, on Python 2), workers raises ImportError.
+        '''
+        if isinstance(paths, _string_types):
+            paths = [paths]
+        self._scheduler.poll()
+        since_time = self._required_time
+        result = {}
+
+        # Answer what we can from the cache, grouping the rest by parent.
+        groups = collections.OrderedDict()
+        for key in paths:
+            abs_path = os.path.abspath(key)
+            node = self._nodes.get(abs_path)
+            if node is not None:
+                st = node._node.peek_stat(since_time)
+                if st is not None:
+                    self.stats.incr('hits')
+                    node._update_atime()
+                    result[key] = st
+                    continue
+            elif self._is_negative(abs_path):
+                self.stats.incr('misses')
+                self.stats.incr('negative_hits')
+                result[key] = None
+                continue
+            groups.setdefault(os.path.dirname(abs_path), []).append(
+                    (key, abs_path))
+
+        tasks = []
+        for (dir_name, items) in groups.items():
+            parent = _Node.find_node(dir_name, self._backend)
+            children = None
+            if parent is not None:
+                children = parent.peek_children(since_time)
+            if children is not None:
+                # Paths missing from a current listing don't exist.  (The
+                # root is its own parent, but not in its own listing.)
+                present = []
+                for (key, abs_path) in items:
+                    base_name = os.path.basename(abs_path)
+                    if (not base_name) or (base_name in children):
+                        present.append((key, abs_path))
+                    else:
+                        self.stats.incr('misses')
+                        self.stats.incr('not_found')
+                        result[key] = None
+                items = present
+            elif self._backend.ENTRY_HAS_STAT and (len(items) > 1):
+                # One listing gives the statistics of all of these.
+                tasks.append((dir_name, items))
+                continue
+
+            for start in range(0, len(items), _STAT_CHUNK):
+                tasks.append((None, items[start:start + _STAT_CHUNK]))
+
+        if workers is None:
+            for (dir_name, items) in tasks:
+                result.update(self._stat_group(dir_name, items, since_time))
+            return result
+
+        if futures is None:  # pragma: no cover
+            raise ImportError('workers require the futures package')
+
+        executor = futures.ThreadPoolExecutor(max_workers=workers)
+        try:
+            for found in executor.map(
+                    lambda task : self._stat_group(task[0], task[1],
+                        since_time), tasks):
+                result.update(found)
+        finally:
+            executor.shutdown(wait=False)
+        return result
+
+    def _stat_group(self, dir_name, items, since_time):
+        '''
+        Retrieve the statistics for a list of (key, abs_path) pairs in the
+        same directory, returning (key, statistics) pairs, the statistics
+        being None for paths that do not exist.  If dir_name is given, that
+        directory is listed first.
+        '''
+        if dir_name is not None:
+            try:
+                parent = self._get_node(dir_name, dir_name)
+                parent._node.get_children(since_time,
+                        self._validate_listing, self)
+            except (KeyError, OSError):
+                return [(key, None) for (key, abs_path) in items]
+
+        found = []
+        for (key, abs_path) in items:
+            try:
+                node = self._get_node(abs_path, key)
+                found.append((key, node._node.get_stat(since_time, self)))
+            except (KeyError, OSError):
+                found.append((key, None))
+        return found
+
+    def save(self, path):
+        '''
+        Save a snapshot of the cached metadata to the named file, for a
+        later process to load.  Returns the number of nodes saved.
+        '''
+        return snapshot.save(self, path)
+
+    def load(self, path):
+        '''
+        Load a snapshot written by save.  Loaded directory listings are
+        checked against the directory's modification and change times
+        before they are used, and only re-read if those differ; other
+        statistics are retrieved afresh.  Nodes are only added to the cache
+        when looked up, once found to exist.  Returns the number of nodes
+        loaded.  Raises ValueError if the file is not a snapshot.
+        '''
+        return snapshot.load(self, path)
+
+
+def _join_rest(path, rest):
+    '''
+    Join the unresolved remainder of a path onto path, as os.path.realpath
+    does when it finds a link loop (with no trailing separator).
+    '''
+    if rest:
+        return os.path.join(path, rest)
+    return path
+
+
+def _prefetch_node(node, file_type=None):
+    '''
+    Fetch the statistics of a node, and its target if it is a symbolic
+    link.  Returns the node's file type, or None if it has vanished.
+    '''
+    try:
+        node.stat
+        if file_type is None:
+            file_type = node.file_type
+        if file_type == stat.S_IFLNK:
+            node.target
+    except OSError:
+        return None
+    return file_type
+
+
+def _prefetch_dir(node, recursive):
+    '''
+    List a directory and fetch the statistics of its children.  Returns
+    the number of nodes fetched and, if recursive, the sub-directories
+    found.
+    '''
+    fetched = 0
+    subdirs = []
+    for (child, file_type) in node._entries():
+        if _prefetch_node(child, file_type) is None:
+            continue
+        fetched += 1
+        if recursive and (file_type == stat.S_IFDIR):
+            subdirs.append(child)
+    return (fetched, subdirs)
+
+
+def _estimate_size(node):
+    '''
+    Estimate the memory held by a node: the node objects and its path.
+    Statistics and listings are shared between caches, and not counted.
+    '''
+    return sys.getsizeof(node) + sys.getsizeof(node._node) \
+            + sys.getsizeof(node.abs_path)
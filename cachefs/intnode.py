@@ -5,38 +5,151 @@
 #
 # vim: set ts=4 sts=4 et tw=78 sw=4:
 
-import weakref
 import time
 import os
+import stat
 import threading
 
+from .backend import _LOCAL
+from .stats import Stats
+from .trace import _tracers
+
+# A directory changed less than this many seconds before it was listed may
+# change again without its timestamps moving on file systems with coarse
+# time stamps, so such listings are not trusted when validating.
+_RACY_WINDOW = 1.0
+
+
+# Flags for _Node._busy, marking a refresh in progress.
+_BUSY_STAT      = 0x1
+_BUSY_CHILDREN  = 0x2
+_BUSY_TARGET    = 0x4
+
+
+def _change_key(st):
+    '''
+    Return a value that changes whenever the directory described by the
+    statistics "st" is modified or replaced.
+    '''
+    return (st.st_dev, st.st_ino,
+            getattr(st, 'st_mtime_ns', st.st_mtime),
+            getattr(st, 'st_ctime_ns', st.st_ctime))
+
+
+def _call(cache, op, path, fn, *args):
+    '''
+    Make a file system call, fn(*args), for the operation "op" on "path" on
+    behalf of "cache" (or None).  The time taken is recorded in the
+    process-wide statistics and the cache's, and the call is traced.
+    '''
+    tracers = _tracers(cache)
+    for tracer in tracers:
+        tracer.before(op, path, cache)
+
+    error = None
+    start = time.time()
+    try:
+        return fn(*args)
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        elapsed = time.time() - start
+        _Node.stats.record(op, elapsed)
+        if cache is not None:
+            cache.stats.record(op, elapsed)
+        for tracer in tracers:
+            tracer.after(op, path, cache, elapsed, error)
+
+
+def _entry_type(entry):
+    '''
+    Return the file type (as per stat.S_IFMT) reported by a directory entry,
+    or None if it cannot be determined from the entry alone.
+    '''
+    try:
+        if entry.is_symlink():
+            return stat.S_IFLNK
+        elif entry.is_dir(follow_symlinks=False):
+            return stat.S_IFDIR
+        elif entry.is_file(follow_symlinks=False):
+            return stat.S_IFREG
+    except OSError:
+        pass
+    return None
+
+
 class _Node(object):
     '''
     This is a back-end caching object, which is referenced by the
     user-accessible Node object.
     '''
 
-    # A listing of all possible nodes, by absolute path.
-    _ALL_NODES = weakref.WeakValueDictionary()
-    _ALL_NODES_LK = threading.Lock()
+    __slots__ = ('_lk', '_backend', 'abs_path', '_base_name', '_dir_name',
+            '_last_stat', '_stat', '_children_last', '_children_key',
+            '_children', '_entries', '_file_type', '_type_last',
+            '_target', '_target_last', '_watched', '_busy', '__weakref__')
+
+    # Lock guarding the lazy creation of per-node locks.
+    _LOCK_INIT_LK = threading.Lock()
+
+    # Process-wide statistics: nodes created, and all file system calls.
+    stats = Stats()
 
     @classmethod
-    def get_node(cls, abs_path):
-        with cls._ALL_NODES_LK:
-            try:
-                node = cls._ALL_NODES[abs_path]
-            except KeyError:
-                node = cls(abs_path)
+    def get_node(cls, abs_path, backend=None):
+        '''
+        Return the node for the given path in the registry of the given
+        back-end (by default, the local file system), creating it if need
+        be.
+        '''
+        if backend is None:
+            backend = _LOCAL
+        shard = hash(abs_path) % backend._SHARDS
+        nodes = backend._nodes[shard]
+
+        # Existing nodes can be found without taking the lock.
+        node = nodes.get(abs_path)
+        if node is None:
+            with backend._nodes_lk[shard]:
+                node = nodes.get(abs_path)
+                if node is None:
+                    node = cls(abs_path, backend)
+                    node._seed()
+                    nodes[abs_path] = node
+                    cls.stats.incr('created')
         return node
 
-    def __init__(self, abs_path):
-        assert self._ALL_NODES_LK.locked(), \
-                'Mutex not locked'
-        assert abs_path not in self._ALL_NODES, \
-                'Duplicate for %r' % abs_path
+    @classmethod
+    def find_node(cls, abs_path, backend=None):
+        '''
+        Return the node for the given path if it exists, otherwise None.
+        '''
+        if backend is None:
+            backend = _LOCAL
+        return backend._nodes[hash(abs_path) % backend._SHARDS].get(abs_path)
+
+    @classmethod
+    def all_nodes(cls, backend=None):
+        '''
+        Return a list of all nodes currently in existence.
+        '''
+        if backend is None:
+            backend = _LOCAL
+        all_nodes = []
+        for (nodes, lock) in zip(backend._nodes, backend._nodes_lk):
+            with lock:
+                all_nodes.extend(nodes.values())
+        return all_nodes
+
+    def __init__(self, abs_path, backend=None):
+        # Multithreading lock (lazy creation, see _lock)
+        self._lk = None
 
-        # Multithreading lock
-        self._lock = threading.Lock()
+        # File system back-end
+        if backend is None:
+            backend = _LOCAL
+        self._backend = backend
 
         # Full path of this node
         self.abs_path = abs_path
@@ -56,11 +169,25 @@ class _Node(object):
         # Modification time of directory when last listing was collected
         self._children_last = 0.0
 
-        # Known children, by name
-        self._children = set()
+        # Change key (see _change_key) of the directory when last listed, if
+        # it can be trusted to validate the listing.
+        self._children_key = None
+
+        # Known children, by name (lazy; only directories are listed)
+        self._children = None
 
-        # Make ourselves known.
-        self._ALL_NODES[abs_path] = self
+        # Details of each child seen in the last listing, by name, as
+        # (file type, statistics, time of statistics, link target) tuples.
+        # These are kept here, rather than in the child nodes, so that the
+        # details aren't lost when a child is freed, without the listing
+        # holding every child alive.
+        self._entries = None
+
+        # File type reported by the parent directory listing
+        self._file_type = None
+
+        # Time of the parent directory listing that reported the file type
+        self._type_last = 0.0
 
         # Link target name
         self._target = None
@@ -68,6 +195,27 @@ class _Node(object):
         # Target modification time
         self._target_last = 0.0
 
+        # Whether a watcher reports changes to this node, in which case
+        # cached data is kept until invalidated rather than expired.
+        self._watched = False
+
+        # Refreshes in progress (a mask of _BUSY_* flags)
+        self._busy = 0
+
+    @property
+    def _lock(self):
+        '''
+        Return the lock for this node, creating it on first use.
+        '''
+        lock = self._lk
+        if lock is None:
+            with self._LOCK_INIT_LK:
+                lock = self._lk
+                if lock is None:
+                    lock = threading.Lock()
+                    self._lk = lock
+        return lock
+
     @property
     def dir_name(self):
         if self._dir_name is None:
@@ -80,48 +228,253 @@ class _Node(object):
             self._base_name = os.path.basename(self.abs_path)
         return self._base_name
 
-    def _get_stat(self, since_time):
-        if since_time > self._last_stat:
+    def _expired(self, last, since_time):
+        '''
+        Return True if data retrieved at "last" is not newer than
+        "since_time".  Data for watched nodes never expires, but is discarded
+        when the node is invalidated.
+        '''
+        if self._watched:
+            return not last
+        return since_time > last
+
+    def _single_flight(self, busy, last_attr, value_attr, get, *args):
+        '''
+        Call get(*args) with the lock held.  If a refresh of the same data
+        (flagged by "busy") is already in progress, wait for it to finish and
+        return what it retrieved rather than starting another.
+        '''
+        if not (self._busy & busy):
+            with self._lock:
+                return get(*args)
+
+        last = getattr(self, last_attr)
+        with self._lock:
+            current = getattr(self, last_attr)
+            if current and (current != last):
+                return getattr(self, value_attr)
+            # That refresh failed or was invalidated; try our own.
+            return get(*args)
+
+    def _get_stat(self, since_time, cache=None):
+        if self._expired(self._last_stat, since_time):
             # Refresh the statistics.
-            self._stat = os.lstat(self.abs_path)
-            self._last_stat = time.time()
+            self._busy |= _BUSY_STAT
+            try:
+                self._stat = _call(cache, 'stat', self.abs_path,
+                        self._backend.lstat, self.abs_path)
+                self._last_stat = time.time()
+            finally:
+                self._busy &= ~_BUSY_STAT
         return self._stat
 
-    def _get_children(self, since_time):
-        if since_time > self._children_last:
-            # Update the child listing.
-            self._children = set(os.listdir(self.abs_path))
-            self._children_last = time.time()
+    def _get_children(self, since_time, validate=False, cache=None):
+        if self._expired(self._children_last, since_time):
+            self._busy |= _BUSY_CHILDREN
+            try:
+                self._refresh_children(since_time, validate, cache)
+            finally:
+                self._busy &= ~_BUSY_CHILDREN
         return self._children
 
-    def _get_target(self, since_time):
-        if since_time > self._target_last:
+    def _refresh_children(self, since_time, validate, cache=None):
+        # Listings loaded from a snapshot (see cachefs.snapshot) have a
+        # change key but were never listed here; these are always validated.
+        if validate or ((self._children_key is not None) \
+                and not self._children_last):
+            # Check whether the directory changed since it was listed.  The
+            # statistics are always fetched afresh: cached ones may predate
+            # a change made since, and would vouch for a stale listing.
+            st = self._get_stat(float('inf'), cache)
+            key = _change_key(st)
+            if key == self._children_key:
+                self._revalidated(self._last_stat)
+                return
+
+            if (time.time() - max(st.st_mtime, st.st_ctime)) \
+                    > _RACY_WINDOW:
+                self._children_key = key
+            else:
+                self._children_key = None
+
+        # Update the child listing.  It is current as of when it was begun.
+        now = time.time()
+        if not self._backend.SCANDIR:  # pragma: no cover
+            self._children = set(_call(cache, 'children', self.abs_path,
+                self._backend.listdir, self.abs_path))
+        else:
+            _call(cache, 'children', self.abs_path, self._scan_children, now)
+        self._children_last = now
+
+    def _revalidated(self, now):
+        '''
+        Mark the child listing as current.  Nothing has been added to,
+        removed from or replaced in the directory since it was listed, so
+        the file types and link targets of the children retrieved since
+        then are current too.  Those retrieved before may be stale.
+        '''
+        listed = self._children_last
+        self._children_last = now
+        if self._children is None:
+            return
+        for name in self._children:
+            child = self.find_node(os.path.join(self.abs_path, name),
+                    self._backend)
+            if child is None:
+                continue
+            if (child._file_type is not None) \
+                    and (child._type_last >= listed):
+                child._type_last = now
+            if (child._target is not None) \
+                    and (child._target_last >= listed):
+                child._target_last = now
+
+    def _scan_children(self, now):
+        '''
+        Update the child listing using scandir(), recording the file type
+        (and on some platforms, the statistics) of each child as we go.
+        The listing is current as of "now".
+        '''
+        has_stat = self._backend.ENTRY_HAS_STAT
+        entries = {}
+        for entry in self._backend.scandir(self.abs_path):
+            st = None
+            if has_stat:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    pass
+            entries[entry.name] = (_entry_type(entry), st, now, None)
+
+            # Children already in existence are brought up to date.
+            child = self.find_node(os.path.join(self.abs_path, entry.name),
+                    self._backend)
+            if child is not None:
+                child._set_entry(entries[entry.name], now)
+        self._entries = entries
+        self._children = set(entries)
+
+    def _seed(self):
+        '''
+        Fill in a new node with the details recorded by its parent's
+        listing, if any.
+        '''
+        parent = self.find_node(self.dir_name, self._backend)
+        if (parent is None) or (parent._entries is None):
+            return
+        entry = parent._entries.get(self.base_name)
+        if entry is not None:
+            self._set_entry(entry, parent._children_last)
+
+    def _set_entry(self, entry, listed):
+        '''
+        Record the details of this node from its parent's listing (as per
+        _entries), which was last known current at "listed".
+        '''
+        (file_type, st, st_last, target) = entry
+        if file_type is not None:
+            self._file_type = file_type
+            self._type_last = listed
+        if st is not None:
+            self._stat = st
+            self._last_stat = st_last
+        if target is not None:
+            self._target = target
+            self._target_last = listed
+
+    def _get_target(self, since_time, cache=None):
+        if self._expired(self._target_last, since_time):
             # Update the link target.
-            self._target = os.readlink(self.abs_path)
-            self._target_last = time.time()
+            self._busy |= _BUSY_TARGET
+            try:
+                self._target = _call(cache, 'target', self.abs_path,
+                        self._backend.readlink, self.abs_path)
+                self._target_last = time.time()
+            finally:
+                self._busy &= ~_BUSY_TARGET
+        return self._target
+
+    def invalidate(self):
+        '''
+        Discard all cached information about this node, so that it is
+        retrieved again on next access.
+        '''
+        with self._lock:
+            self._last_stat = 0.0
+            self._children_last = 0.0
+            self._children_key = None
+            self._target_last = 0.0
+            self._type_last = 0.0
+
+    def peek_stat(self, since_time):
+        '''
+        Return the statistics if they're newer than "since_time", otherwise
+        None.  This never performs I/O.
+        '''
+        if self._expired(self._last_stat, since_time):
+            return None
+        return self._stat
+
+    def peek_children(self, since_time):
+        '''
+        Return the child listing if it's newer than "since_time", otherwise
+        None.  This never performs I/O.
+        '''
+        if self._expired(self._children_last, since_time):
+            return None
+        return self._children
+
+    def peek_target(self, since_time):
+        '''
+        Return the link target if it's newer than "since_time", otherwise
+        None.  This never performs I/O.
+        '''
+        if self._expired(self._target_last, since_time):
+            return None
         return self._target
 
-    def get_stat(self, since_time):
+    def get_stat(self, since_time, cache=None):
         '''
         Retrieve the statistics, refreshing them if they're not newer than
         "since_time" (a Unix timestamp; from time.time()).
+
+        Any file system calls made by this or the other getters are made
+        on behalf of "cache" (a CacheFs instance) if given: they are timed
+        in its statistics, and traced by its tracer.
         '''
-        with self._lock:
-            return self._get_stat(since_time)
+        return self._single_flight(_BUSY_STAT, '_last_stat', '_stat',
+                self._get_stat, since_time, cache)
 
-    def get_target(self, since_time):
+    def get_file_type(self, since_time, cache=None):
+        '''
+        Retrieve the file type (as per stat.S_IFMT), using the type reported
+        by the parent directory listing if that is newer than "since_time",
+        otherwise from the statistics.
+        '''
+        if (self._file_type is not None) and \
+                not self._expired(self._type_last, since_time):
+            return self._file_type
+        return stat.S_IFMT(self.get_stat(since_time, cache).st_mode)
+
+    def get_target(self, since_time, cache=None):
         '''
         Retrieve the link target, refreshing it if it's not newer than
         "since_time" (a Unix timestamp; from time.time()).
         '''
-        with self._lock:
-            return self._get_target(since_time)
+        return self._single_flight(_BUSY_TARGET, '_target_last', '_target',
+                self._get_target, since_time, cache)
 
-    def get_children(self, since_time):
+    def get_children(self, since_time, validate=False, cache=None):
         '''
-        Retrieve the child listing for this node, refreshing if the modification
-        time of this node is greater than what it was when the child list was
-        last retrieved.
+        Retrieve the child listing for this node, refreshing it if it's not
+        newer than "since_time" (a Unix timestamp; from time.time()).
+
+        If "validate" is set, an expired listing is only re-read if the
+        modification or change time of this node differs from what it was
+        when the child list was last retrieved.
+
+        Callers arriving whilst a refresh is in progress share its result.
         '''
-        with self._lock:
-            return self._get_children(since_time)
+        return self._single_flight(_BUSY_CHILDREN, '_children_last',
+                '_children', self._get_children, since_time, validate,
+                cache)
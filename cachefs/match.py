@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Cached file-system utility library
+# (C) 2016 VRT Systems
+#
+# vim: set ts=4 sts=4 et tw=78 sw=4 si:
+
+import fnmatch
+import re
+import stat
+
+try:
+    _string_types = basestring
+except NameError:
+    _string_types = str
+
+
+class Match(object):
+    '''
+    A set of filters for Node.find, compiled into a single matcher.  A node
+    matches if it passes every filter given:
+
+    - name: glob pattern (or list of patterns) for the base name
+    - path: glob pattern (or list of patterns) for the absolute path
+    - regex: regular expression searched for in the absolute path
+    - file_type: file type (or list of types), either as a stat.S_IF*
+      constant or one of the letters used by find(1): 'f', 'd', 'l', 'b',
+      'c', 'p' or 's'
+    - min_size, max_size: range of sizes (inclusive), in bytes
+    - min_mtime, max_mtime: range of modification times (inclusive), as
+      Unix timestamps
+
+    Name and path filters are checked first, then file type, and only then
+    the statistics, so nodes are only stat'ed if they match by name.
+
+    prune gives glob patterns (or a list of them) for the base names of
+    directories that should not be searched, e.g. ['.git', 'node_modules'].
+    '''
+
+    # File types by find(1) letter
+    FILE_TYPES = {
+        'f':    stat.S_IFREG,
+        'd':    stat.S_IFDIR,
+        'l':    stat.S_IFLNK,
+        'b':    stat.S_IFBLK,
+        'c':    stat.S_IFCHR,
+        'p':    stat.S_IFIFO,
+        's':    stat.S_IFSOCK,
+    }
+
+    def __init__(self, name=None, path=None, regex=None, file_type=None,
+            min_size=None, max_size=None, min_mtime=None, max_mtime=None,
+            prune=None):
+        self._name = _compile_globs(name)
+        self._path = _compile_globs(path)
+        self._prune = _compile_globs(prune)
+
+        if isinstance(regex, _string_types):
+            regex = re.compile(regex)
+        self._regex = regex
+
+        if file_type is None:
+            self._file_types = None
+        else:
+            if isinstance(file_type, _string_types) \
+                    or not hasattr(file_type, '__iter__'):
+                file_type = [file_type]
+            self._file_types = frozenset([
+                self.FILE_TYPES.get(t, t) for t in file_type])
+
+        self._min_size = min_size
+        self._max_size = max_size
+        self._min_mtime = min_mtime
+        self._max_mtime = max_mtime
+        self._check_stat = any([limit is not None for limit in
+            (min_size, max_size, min_mtime, max_mtime)])
+
+    def __call__(self, node):
+        '''
+        Return True if the node matches all the filters.
+        '''
+        if (self._name is not None) \
+                and (self._name.match(node.base_name) is None):
+            return False
+        if (self._path is not None) \
+                and (self._path.match(node.abs_path) is None):
+            return False
+        if (self._regex is not None) \
+                and (self._regex.search(node.abs_path) is None):
+            return False
+        if (self._file_types is not None) \
+                and (node.file_type not in self._file_types):
+            return False
+
+        if not self._check_stat:
+            return True
+
+        st = node.stat
+        if (self._min_size is not None) and (st.st_size < self._min_size):
+            return False
+        if (self._max_size is not None) and (st.st_size > self._max_size):
+            return False
+        if (self._min_mtime is not None) and (st.st_mtime < self._min_mtime):
+            return False
+        if (self._max_mtime is not None) and (st.st_mtime > self._max_mtime):
+            return False
+        return True
+
+    def prune(self, node):
+        '''
+        Return True if the directory node should not be searched.
+        '''
+        return (self._prune is not None) \
+                and (self._prune.match(node.base_name) is not None)
+
+
+def _compile_globs(patterns):
+    '''
+    Compile a glob pattern, or list of patterns, into one regular
+    expression.  Returns None if there are no patterns.
+    '''
+    if isinstance(patterns, _string_types):
+        patterns = [patterns]
+    if not patterns:
+        return None
+    return re.compile('|'.join(['(?:%s)' % fnmatch.translate(p)
+        for p in patterns]))
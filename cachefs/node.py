@@ -11,9 +11,16 @@ import errno
 import collections
 import stat
 import weakref
+import threading
 
 from .intnode import _Node
 
+try:
+    from concurrent import futures
+except ImportError:  # pragma: no cover
+    # Python 2 without the 'futures' back-port.
+    futures = None
+
 
 class Node(collections.Mapping):
     '''
@@ -22,11 +29,16 @@ class Node(collections.Mapping):
     metadata for that node.
     '''
 
+    __slots__ = ('_cache', '_node', '_atime', '_size', '__weakref__')
+
     def __init__(self, cache, abs_path):
         self._cache = weakref.ref(cache)
-        self._node = _Node.get_node(abs_path)
+        self._node = _Node.get_node(abs_path, cache._backend)
         self._atime = time.time()
 
+        # Estimated memory held by this node, for the cache's accounting.
+        self._size = 0
+
     def _update_atime(self):
         self._atime = time.time()
 
@@ -118,14 +130,17 @@ class Node(collections.Mapping):
         Return the result of os.stat() on this file.
         '''
         self._update_atime()
-        return self._node.get_stat(self._cache()._required_time)
+        cache = self._cache()
+        return self._node.get_stat(cache._required_time, cache)
 
     @property
     def file_type(self):
         '''
         Returns the file type for the file.
         '''
-        return stat.S_IFMT(self.stat.st_mode)
+        self._update_atime()
+        cache = self._cache()
+        return self._node.get_file_type(cache._required_time, cache)
 
     @property
     def is_socket(self):  # pragma: no cover
@@ -195,7 +210,8 @@ class Node(collections.Mapping):
         '''
         Returns the name of the file the symlink points to.
         '''
-        return self._node.get_target(self._cache()._required_time)
+        cache = self._cache()
+        return self._node.get_target(cache._required_time, cache)
 
     @property
     def abs_target(self):
@@ -212,8 +228,9 @@ class Node(collections.Mapping):
     def abs_final_target(self):
         '''
         Returns the absolute path for the target, following all symlinks.
+        Each component is resolved through the cache.
         '''
-        return os.path.realpath(self.abs_path)
+        return self._cache()._realpath(self.abs_path)
 
     @property
     def target_node(self):
@@ -244,65 +261,167 @@ class Node(collections.Mapping):
         Return an iterator for all the children in this directory.
         '''
         self._update_atime()
-        return iter(self._node.get_children(\
-                self._cache()._required_time).copy())
+        cache = self._cache()
+        return iter(self._node.get_children(cache._required_time,
+                cache._validate_listing, cache).copy())
 
     def __len__(self):
         '''
         Return the number of child elements in the directory.
         '''
         self._update_atime()
-        return len(self._node.get_children(\
-                self._cache()._required_time))
+        cache = self._cache()
+        return len(self._node.get_children(cache._required_time,
+                cache._validate_listing, cache))
 
     # Searching for child nodes.
 
-    def _find(self, predicate, depth_predicate, depth, depth_first):
+    def _entries(self):
+        '''
+        Return a list of (child, file_type) tuples for this directory,
+        looking up each child and its type just once.  Children that vanish
+        whilst doing so are skipped.
+        '''
+        self._update_atime()
+        cache = self._cache()
+        since_time = cache._required_time
+        cache._scheduler.poll()
+
+        entries = []
+        for name in self._node.get_children(since_time,
+                cache._validate_listing, cache):
+            try:
+                child = cache._get_node(os.path.join(self.abs_path, name),
+                        name)
+                entries.append((child,
+                    child._node.get_file_type(since_time, cache)))
+            except (KeyError, OSError):
+                continue
+        return entries
+
+    def _find(self, predicate, depth_predicate, depth_first, follow_links,
+            prune):
         if self.is_link:
-            for found in self.final_target_node._find(
-                    predicate, depth_predicate, depth, depth_first):
-                yield found
-            return
-
-        child_depth = depth+1
-        show_self = (depth == 0) and depth_predicate(depth)
-        show_children = depth_predicate(child_depth)
-        recurse = depth_predicate(depth, True)
-
+            # Search the link's final target, unless the link loops, in which
+            # case it resolves to a link and is treated as a file.
+            target = self.final_target_node
+            if not target.is_link:
+                for found in target._find(predicate, depth_predicate,
+                        depth_first, follow_links, prune):
+                    yield found
+                return
+
+        show_self = depth_predicate(0)
         if not self.is_dir:
             if show_self and predicate(self):
                 yield self
             return
 
-        def _recurse():
-            if recurse:
-                for child in self.values():
-                    if not child.is_dir:
-                        continue
+        # Physical directories already searched, when following links.
+        visited = set()
+        if follow_links:
+            visited.add(_dir_key(self))
+
+        # Directories still to be searched, as (node, depth), and in
+        # depth-first order, lists of nodes to report once the directories
+        # above them on the stack are done, as (nodes, None).
+        stack = [(self, 0)]
+        while stack:
+            (item, depth) = stack.pop()
+            if depth is None:
+                for node in item:
+                    if predicate(node):
+                        yield node
+                continue
+
+            child_depth = depth+1
+            show_children = depth_predicate(child_depth)
+            recurse = depth_predicate(depth, True)
+
+            # Each child is visited once, for both reporting and recursion.
+            if show_children or recurse:
+                entries = item._entries()
+            else:
+                entries = []
 
-                    for found in child._find(predicate, depth_predicate,
-                            child_depth, depth_first):
-                        yield found
-        def _children():
             if show_children:
-                for child in self.values():
-                    if predicate(child):
-                        yield child
-        def _self():
-            if show_self and predicate(self):
-                yield self
+                report = [child for (child, file_type) in entries]
+            else:
+                report = []
+
+            if (depth == 0) and show_self:
+                if depth_first:
+                    report.append(item)
+                else:
+                    report.insert(0, item)
+
+            if depth_first:
+                stack.append((report, None))
+            else:
+                for node in report:
+                    if predicate(node):
+                        yield node
 
-        # Generators
-        generators = [_self(), _children(), _recurse()]
-        if depth_first:
-            generators.reverse()
+            if recurse:
+                subdirs = _subdirs(entries, follow_links, prune)
+                if follow_links:
+                    subdirs = [(subdir, key) for (subdir, key) in subdirs
+                            if _first_visit(visited, key)]
+                stack.extend([(subdir, child_depth) for (subdir, key)
+                    in reversed(subdirs)])
+
+    def _find_parallel(self, predicate, depth_predicate, executor,
+            follow_links, prune):
+        if self.is_link:
+            # As for _find, a looping link is treated as a file.
+            target = self.final_target_node
+            if not target.is_link:
+                for found in target._find_parallel(predicate,
+                        depth_predicate, executor, follow_links, prune):
+                    yield found
+                return
 
-        for g in generators:
-            for found in g:
-                yield found
+        if depth_predicate(0) and predicate(self):
+            yield self
+
+        if not self.is_dir:
+            return
+
+        visited = set()
+        if follow_links:
+            visited.add(_dir_key(self))
+
+        pending = set([executor.submit(_scan_dir, self, 0, follow_links,
+            prune)])
+        try:
+            while pending:
+                (done, pending) = futures.wait(pending,
+                        return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    (depth, entries, subdirs) = future.result()
+                    child_depth = depth+1
+                    show_children = depth_predicate(child_depth)
+                    recurse = depth_predicate(child_depth, True)
+
+                    if show_children:
+                        for (child, file_type) in entries:
+                            if predicate(child):
+                                yield child
+
+                    if not recurse:
+                        continue
+                    for (subdir, key) in subdirs:
+                        if follow_links and not _first_visit(visited, key):
+                            continue
+                        pending.add(executor.submit(_scan_dir,
+                            subdir, child_depth, follow_links, prune))
+        finally:
+            for future in pending:
+                future.cancel()
 
     def find(self, predicate=None, depth=None, min_depth=None, max_depth=None,
-            depth_first=False):
+            depth_first=False, workers=None, ordered=False,
+            follow_links=False, match=None, prune=None):
         '''
         Attempt to find nodes that match the given predicate.  The depth
         parameters control the minimum and maximum path depth (with depth
@@ -310,6 +429,26 @@ class Node(collections.Mapping):
 
         Each node is passed to the function called predicate which returns
         True or False.  If it returns True, find yields that node.
+
+        If workers is given, directories are listed concurrently by a pool of
+        that many threads.  Results are yielded as each directory is listed,
+        in no particular order (depth_first is ignored), unless ordered is
+        set, in which case the pool reads ahead of a normal search and
+        results are yielded in the usual order.  Without concurrent.futures
+        (the futures package, on Python 2), ImportError is raised.
+
+        If follow_links is set, symbolic links to directories are searched
+        as well.  Each physical directory (by device and inode) is then only
+        searched once, however many links lead to it.
+
+        match may be a cachefs.Match, giving declarative filters that are
+        checked (cheapest first) before the predicate, and patterns for
+        directories not to search.
+
+        prune, if given, is called with each directory found below this one
+        (and each symbolic link to a directory, if follow_links is set).  If
+        it returns True, that directory is not searched.  It is still passed
+        to the predicate, and may be yielded.
         '''
         if depth is not None:
             depth_predicate = lambda d, r=False : \
@@ -328,5 +467,120 @@ class Node(collections.Mapping):
 
         if predicate is None:
             predicate = lambda n : True
-        for found in self._find(predicate, depth_predicate, 0, depth_first):
-            yield found
+
+        if match is not None:
+            user_predicate = predicate
+            predicate = lambda n : match(n) and user_predicate(n)
+            if prune is None:
+                prune = match.prune
+            else:
+                user_prune = prune
+                prune = lambda n : match.prune(n) or user_prune(n)
+
+        if workers is None:
+            for found in self._find(predicate, depth_predicate,
+                    depth_first, follow_links, prune):
+                yield found
+            return
+
+        if futures is None:  # pragma: no cover
+            raise ImportError('workers require the futures package')
+
+        executor = futures.ThreadPoolExecutor(max_workers=workers)
+        stop = threading.Event()
+        try:
+            if ordered:
+                executor.submit(_read_ahead, self, executor, stop, prune)
+                results = self._find(predicate, depth_predicate,
+                        depth_first, follow_links, prune)
+            else:
+                results = self._find_parallel(predicate, depth_predicate,
+                        executor, follow_links, prune)
+            for found in results:
+                yield found
+        finally:
+            stop.set()
+            executor.shutdown(wait=False)
+
+
+def _dir_key(node):
+    '''
+    Return a key identifying the physical directory behind a node.
+    '''
+    st = node.stat
+    if st.st_ino:
+        return (st.st_dev, st.st_ino)
+    # No inode numbers on this platform.
+    return node.abs_path
+
+
+def _first_visit(visited, key):
+    '''
+    Record a directory key as visited, returning False if it already was.
+    '''
+    if key in visited:
+        return False
+    visited.add(key)
+    return True
+
+
+def _subdirs(entries, follow_links, prune=None):
+    '''
+    From a list of (child, file_type) tuples, return (node, key) for each
+    directory to descend into, including the targets of symbolic links to
+    directories if follow_links is set, and skipping children for which
+    prune returns True.  The key is only computed (by _dir_key) when
+    following links; otherwise it is None.
+    '''
+    subdirs = []
+    for (child, file_type) in entries:
+        if file_type == stat.S_IFDIR:
+            subdir = child
+        elif follow_links and (file_type == stat.S_IFLNK):
+            try:
+                subdir = child.final_target_node
+                if not subdir.is_dir:
+                    continue
+            except (KeyError, OSError):
+                # Broken link.
+                continue
+        else:
+            continue
+
+        if (prune is not None) and prune(child):
+            continue
+        elif follow_links:
+            subdirs.append((subdir, _dir_key(subdir)))
+        else:
+            subdirs.append((subdir, None))
+    return subdirs
+
+
+def _scan_dir(node, depth, follow_links=False, prune=None):
+    '''
+    List a directory, returning its depth, a list of (child, file_type)
+    tuples and the sub-directories to descend into (see _subdirs).  This is
+    run in a worker thread by the parallel search.
+    '''
+    entries = node._entries()
+    return (depth, entries, _subdirs(entries, follow_links, prune))
+
+
+def _read_ahead(node, executor, stop, prune=None):
+    '''
+    List a directory, then queue its sub-directories to be listed the same
+    way, warming the cache ahead of an ordered search until "stop" is set.
+    '''
+    if stop.is_set():
+        return
+    elif node.is_link:
+        node = node.final_target_node
+    if not node.is_dir:
+        return
+
+    for (subdir, key) in _scan_dir(node, 0, prune=prune)[2]:
+        try:
+            executor.submit(_read_ahead, subdir, executor, stop, prune)
+        except RuntimeError:
+            # The search has finished, and the pool shut down.
+            return
@@ -0,0 +1,264 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Cached file-system utility library
+# (C) 2016 VRT Systems
+#
+# vim: set ts=4 sts=4 et tw=78 sw=4 si:
+
+"""
+On-disk snapshots of the metadata cache, so that a restarted process need not
+list and stat everything again.
+
+A snapshot is a header, a table of names (NUL-separated), then one fixed-size
+record per node, parents before their children.  Each record gives the index
+of the parent's record (-1 for a node saved without its parent, whose name is
+then the absolute path), the file type, the change key of a listed directory
+and the index of the link target in the name table.
+
+Nothing loaded is trusted as-is: listings are validated against the
+directory's change key (one lstat per directory) before use, and the file
+types and link targets of their children are only trusted once that
+succeeds.  Loaded nodes are not added to the cache; each is checked to
+exist when first looked up, as any other node would be (which a validated
+listing makes free).
+"""
+
+import os
+import struct
+import stat
+import time
+
+from .intnode import _Node, _change_key, _RACY_WINDOW
+from .watcher import _fsencode, _fsdecode
+
+
+_MAGIC = b'CFS\x01'
+
+# magic, number of records, number of names, size of the name table
+_HEADER = struct.Struct('<4sIII')
+
+# parent, flags, file type, device, inode, mtime, ctime, target
+_RECORD = struct.Struct('<iBIQQqqi')
+
+# Record flags
+_SNAP_LISTED    = 0x1   # A directory, whose listing was saved
+_SNAP_LISTING   = 0x2   # Named in the parent's listing
+_SNAP_TYPE      = 0x4   # File type is known
+_SNAP_TARGET    = 0x8   # Link target is known
+
+# Whether change keys hold times in nanoseconds (see _change_key).
+_KEY_NS = hasattr(os.stat_result, 'st_mtime_ns')
+
+
+def save(cache, path):
+    '''
+    Write the metadata held by the cache's nodes, and what has been listed
+    of their directories, to the named file.  Directories whose statistics
+    have expired are stat'ed again.  Returns the number of nodes saved.
+    '''
+    since_time = cache._required_time
+
+    # Gather the nodes to save, and the names listed in each directory.
+    nodes = {}
+    listings = {}
+    for node in list(cache._nodes.values()):
+        node = node._node
+        nodes[node.abs_path] = node
+
+        key = _listing_key(node, since_time, cache)
+        if key is None:
+            continue
+        listings[node.abs_path] = key
+        for name in node._children:
+            child_path = os.path.join(node.abs_path, name)
+            if child_path not in nodes:
+                nodes[child_path] = _Node.find_node(child_path,
+                        cache._backend)
+
+    # Parents sort before their children.
+    paths = sorted(nodes, key=len)
+    index = dict((p, i) for (i, p) in enumerate(paths))
+
+    names = []
+    targets = []
+    records = []
+    for abs_path in paths:
+        node = nodes[abs_path]
+        dir_name = os.path.dirname(abs_path)
+        if dir_name == abs_path:
+            # The root, which is its own parent.
+            parent = -1
+        else:
+            parent = index.get(dir_name, -1)
+        flags = 0
+        if parent < 0:
+            names.append(abs_path)
+        else:
+            names.append(os.path.basename(abs_path))
+            if paths[parent] in listings:
+                flags |= _SNAP_LISTING
+
+        file_type = 0
+        key = listings.get(abs_path)
+        link_target = None
+        if node is not None:
+            file_type = _peek_file_type(node, since_time)
+            link_target = node.peek_target(since_time)
+        elif flags & _SNAP_LISTING:
+            # Not in memory; use what the parent's listing recorded.
+            entry = nodes[paths[parent]]._entries.get(names[-1])
+            if entry is not None:
+                file_type = entry[0] or 0
+                link_target = entry[3]
+        target = -1
+        if link_target is not None:
+            target = len(targets)
+            targets.append(link_target)
+        if file_type:
+            flags |= _SNAP_TYPE
+        if key is not None:
+            flags |= _SNAP_LISTED
+        else:
+            key = (0, 0, 0, 0)
+        if target >= 0:
+            flags |= _SNAP_TARGET
+            target += len(paths)
+
+        records.append(_RECORD.pack(parent, flags, file_type,
+            key[0], key[1], _key_time(key[2]), _key_time(key[3]), target))
+
+    table = b'\0'.join([_fsencode(n) for n in names + targets])
+    tmp_path = '%s.tmp%d' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, len(records),
+            len(names) + len(targets), len(table)))
+        f.write(table)
+        f.write(b''.join(records))
+    os.rename(tmp_path, path)
+    return len(records)
+
+
+def load(cache, path):
+    '''
+    Read a snapshot written by save() into the cache.  Details already
+    held for a node are kept in preference to those loaded.  Returns the
+    number of nodes loaded.
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    try:
+        (magic, n_records, n_names, table_size) = \
+                _HEADER.unpack_from(data, 0)
+    except struct.error:
+        raise ValueError('%s is not a cachefs snapshot' % path)
+    offset = _HEADER.size
+    if (magic != _MAGIC) or (len(data) != offset + table_size \
+            + (n_records * _RECORD.size)):
+        raise ValueError('%s is not a cachefs snapshot' % path)
+
+    names = data[offset:offset + table_size].split(b'\0')
+    if (table_size == 0) and not n_names:
+        names = []
+    if len(names) != n_names:
+        raise ValueError('%s is not a cachefs snapshot' % path)
+    names = [_fsdecode(n) for n in names]
+    offset += table_size
+
+    paths = []
+    listed = {}
+    for i in range(n_records):
+        (parent, flags, file_type, dev, ino, mtime, ctime, target) = \
+                _RECORD.unpack_from(data, offset + (i * _RECORD.size))
+        name = names[i]
+        if parent < 0:
+            abs_path = name
+        elif parent < i:
+            abs_path = os.path.join(paths[parent], name)
+        else:
+            raise ValueError('%s is not a cachefs snapshot' % path)
+        paths.append(abs_path)
+
+        node = _Node.get_node(abs_path, cache._backend)
+        if (parent >= 0) and (node._base_name is None):
+            node._base_name = name
+            node._dir_name = paths[parent]
+        with node._lock:
+            if (flags & _SNAP_LISTED) and (node._children is None):
+                node._children_key = (dev, ino,
+                        _from_key_time(mtime), _from_key_time(ctime))
+                node._children = set()
+                node._entries = {}
+                listed[abs_path] = node
+            if (flags & _SNAP_TYPE) and (node._file_type is None):
+                node._file_type = file_type
+            if (flags & _SNAP_TARGET) and (node._target is None):
+                node._target = names[target]
+
+        if flags & _SNAP_LISTING:
+            parent_node = listed.get(paths[parent])
+            if parent_node is not None:
+                parent_node._children.add(name)
+                parent_node._entries[name] = (
+                        (file_type if flags & _SNAP_TYPE else None),
+                        None, 0.0,
+                        (names[target] if flags & _SNAP_TARGET else None))
+
+    # Hold the loaded listings until they are looked up.
+    cache._loaded.update(listed)
+    cache._loaded_time = time.time()
+    return n_records
+
+
+def _listing_key(node, since_time, cache):
+    '''
+    Return the change key to save with a node's listing, or None if the
+    listing is not current or cannot be validated later.
+    '''
+    if node.peek_children(since_time) is None:
+        return None
+    if node._children_key is not None:
+        return node._children_key
+
+    # The listing may be validated against the statistics only if the
+    # directory had not changed for a while before it was listed.  The
+    # statistics may be newer than the listing, as a change since then
+    # moves the times past this point too.
+    try:
+        st = node.get_stat(since_time, cache)
+    except OSError:
+        return None
+    if max(st.st_mtime, st.st_ctime) > node._children_last - _RACY_WINDOW:
+        return None
+    return _change_key(st)
+
+
+def _peek_file_type(node, since_time):
+    '''
+    Return the file type of a node if it is known without I/O, otherwise 0.
+    '''
+    st = node.peek_stat(since_time)
+    if st is not None:
+        return stat.S_IFMT(st.st_mode)
+    elif (node._file_type is not None) \
+            and not node._expired(node._type_last, since_time):
+        return node._file_type
+    return 0
+
+
+def _key_time(value):
+    '''
+    Convert a time from a change key to integer nanoseconds.
+    '''
+    if isinstance(value, float):  # pragma: no cover
+        return int(round(value * 1e9))
+    return value
+
+
+def _from_key_time(value):
+    '''
+    Convert integer nanoseconds to a time for a change key.
+    '''
+    if _KEY_NS:
+        return value
+    return value / 1e9  # pragma: no cover
@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Cached file-system utility library
+# (C) 2016 VRT Systems
+#
+# vim: set ts=4 sts=4 et tw=78 sw=4 si:
+
+"""
+Statistics on how the cache is performing: counters of events such as hits,
+misses and evictions, and histograms of the time taken by each kind of file
+system call.
+"""
+
+import collections
+import threading
+import time
+
+
+class Stats(object):
+    '''
+    A set of named counters and latency histograms.  Histograms have
+    power-of-two buckets, from 1 microsecond up; each bucket counts the
+    calls that took less than its bound (and at least that of the bucket
+    before).
+
+    Statistics are updated on hot paths, and so without locking; they may
+    under-count slightly when updated by several threads at once.
+    '''
+
+    # Number of histogram buckets; the last has no upper bound.
+    BUCKETS = 24
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = collections.defaultdict(int)
+        self._latency = {}
+        self._since = time.time()
+
+    def incr(self, name, count=1):
+        '''
+        Add to the named counter.
+        '''
+        self._counters[name] += count
+
+    def record(self, op, elapsed):
+        '''
+        Record that the operation "op" took "elapsed" seconds.
+        '''
+        hist = self._latency.get(op)
+        if hist is None:
+            hist = self._latency.setdefault(op, _Histogram(self.BUCKETS))
+        hist.count += 1
+        hist.total += elapsed
+        if elapsed > hist.max:
+            hist.max = elapsed
+        bucket = int(elapsed * 1e6).bit_length()
+        if bucket >= self.BUCKETS:
+            bucket = self.BUCKETS - 1
+        hist.buckets[bucket] += 1
+
+    def snapshot(self):
+        '''
+        Return the statistics gathered (since creation or the last reset) as
+        a dict of plain values, suitable for exporting.  Histogram buckets
+        are given as [upper bound in seconds, count] pairs, the last bound
+        being None.
+        '''
+        with self._lock:
+            counters = dict(self._counters)
+            latency = {}
+            for (op, hist) in list(self._latency.items()):
+                latency[op] = {
+                    'count':    hist.count,
+                    'total':    hist.total,
+                    'max':      hist.max,
+                    'buckets':  [[_bucket_bound(n, self.BUCKETS), c]
+                        for (n, c) in enumerate(hist.buckets)],
+                }
+            since = self._since
+
+        return {
+            'since':    since,
+            'time':     time.time(),
+            'counters': counters,
+            'latency':  latency,
+        }
+
+    def reset(self):
+        '''
+        Discard all statistics gathered so far.
+        '''
+        with self._lock:
+            self._counters = collections.defaultdict(int)
+            self._latency = {}
+            self._since = time.time()
+
+
+class _Histogram(object):
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self, buckets):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * buckets
+
+
+def _bucket_bound(n, buckets):
+    '''
+    Return the upper bound, in seconds, of histogram bucket n.
+    '''
+    if n == buckets - 1:
+        return None
+    return (1 << n) * 1e-6
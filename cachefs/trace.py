@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Cached file-system utility library
+# (C) 2016 VRT Systems
+#
+# vim: set ts=4 sts=4 et tw=78 sw=4 si:
+
+"""
+Tracing of the file system calls made by the cache.  A tracer is told of each
+call before it is made and after it returns, with the operation, the path and
+the cache (if any) on whose behalf it was made.
+
+Operations are named:
+
+- 'stat': lstat() of the path
+- 'children': listing of the directory (with scandir() or listdir())
+- 'target': readlink() of the path
+
+The calls are made through the cache's back-end; see cachefs.backend.
+
+Tracers may be given to a CacheFs instance, or added for all caches in the
+process with add_tracer().
+"""
+
+import threading
+
+
+class Tracer(object):
+    '''
+    The interface for a tracer.  Both methods do nothing by default, so a
+    tracer need only override what it uses.  The calls to before() and
+    after() for an operation are made in the same thread, and are not
+    nested.  Tracers should not raise exceptions.
+    '''
+
+    def before(self, op, path, cache):
+        '''
+        Called before the file system call is made.
+        '''
+        pass
+
+    def after(self, op, path, cache, elapsed, error):
+        '''
+        Called after the file system call returns, with the time it took
+        in seconds, and the exception raised (or None).
+        '''
+        pass
+
+
+# Process-wide tracers.  This is replaced, not modified, so that it can be
+# read without locking.
+_TRACERS = ()
+_TRACERS_LK = threading.Lock()
+
+
+def add_tracer(tracer):
+    '''
+    Trace the file system calls made for all caches in the process.
+    '''
+    global _TRACERS
+    if not isinstance(tracer, Tracer):
+        raise TypeError('%r is not a Tracer instance' % tracer)
+    with _TRACERS_LK:
+        _TRACERS = _TRACERS + (tracer,)
+
+
+def remove_tracer(tracer):
+    '''
+    Stop a tracer added with add_tracer.
+    '''
+    global _TRACERS
+    with _TRACERS_LK:
+        _TRACERS = tuple([t for t in _TRACERS if t is not tracer])
+
+
+def _tracers(cache):
+    '''
+    Return the tracers for calls made on behalf of the given cache.
+    '''
+    if (cache is None) or (cache._tracer is None):
+        return _TRACERS
+    return _TRACERS + (cache._tracer,)
@@ -0,0 +1,347 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Cached file-system utility library
+# (C) 2016 VRT Systems
+#
+# vim: set ts=4 sts=4 et tw=78 sw=4 si:
+
+"""
+File system change watchers.  A watcher reports changes to the nodes it is
+watching, allowing their cached data to be trusted until a change is seen
+rather than expiring it after a fixed time.
+"""
+
+import errno
+import os
+import select
+import struct
+import threading
+
+from .intnode import _Node
+
+try:
+    _fsencode = os.fsencode
+    _fsdecode = os.fsdecode
+except AttributeError:  # pragma: no cover
+    # Python 2: paths are already byte strings.
+    _fsencode = _fsdecode = lambda path : path
+
+
+# inotify constants, from <sys/inotify.h>
+IN_MODIFY       = 0x00000002
+IN_ATTRIB       = 0x00000004
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_DELETE_SELF  = 0x00000400
+IN_MOVE_SELF    = 0x00000800
+IN_Q_OVERFLOW   = 0x00004000
+IN_IGNORED      = 0x00008000
+IN_ONLYDIR      = 0x01000000
+IN_DONT_FOLLOW  = 0x02000000
+IN_NONBLOCK     = 0o00004000
+IN_CLOEXEC      = 0o02000000
+
+# Events that change the listing of the watched directory.
+_LISTING_EVENTS = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# Events after which a path no longer refers to what was watched.
+_GONE_EVENTS = IN_MOVED_FROM | IN_DELETE | IN_MOVE_SELF | IN_DELETE_SELF
+
+# Symbolic links to directories are followed: a watch on the link's path
+# is one on the directory it names, whilst changes to the link itself are
+# seen by the watch on its parent.
+_WATCH_MASK = IN_MODIFY | IN_ATTRIB | _LISTING_EVENTS | IN_DELETE_SELF \
+        | IN_MOVE_SELF | IN_ONLYDIR
+
+# struct inotify_event, less the trailing name.
+_EVENT = struct.Struct('iIII')
+
+
+class Watcher(object):  # pragma: no cover
+    '''
+    This is the interface for a file system change watcher.  This is an
+    abstract class.
+    '''
+
+    def watch(self, node):
+        '''
+        Start reporting changes to the given back-end node.  Returns True if
+        the node is now watched, and its cached data may be trusted until
+        invalidated.
+        '''
+        raise NotImplementedError()
+
+    def unwatch(self, node):
+        '''
+        Stop reporting changes to the given back-end node, which reverts to
+        time-based expiry.  Does nothing if the node isn't watched.
+        '''
+        raise NotImplementedError()
+
+    def close(self):
+        '''
+        Stop watching.  All nodes revert to time-based expiry.
+        '''
+        raise NotImplementedError()
+
+
+class InotifyWatcher(Watcher):
+    '''
+    A watcher for Linux, using inotify via ctypes.  Each watched node requires
+    a watch on every directory above it up to the root, both as named and as
+    reached through any symbolic links (inotify reports nothing to the
+    descendants of a directory that is renamed or removed), and if it is a
+    directory, on itself.  Events are processed by a background thread.
+
+    inotify gives one watch per directory, however it is reached, so a watch
+    may serve several paths (through symbolic links); events on it
+    invalidate the nodes under each of them.  Watches are dropped once no
+    watched node needs them.
+    '''
+
+    def __init__(self):
+        self._libc = _load_libc()
+        fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise _last_error()
+        self._fd = fd
+
+        # Watched directories: the paths using each watch descriptor, the
+        # descriptor for each path, and the number of watched nodes
+        # needing each path to be watched.
+        self._lock = threading.Lock()
+        self._wd_paths = {}
+        self._path_wd = {}
+        self._path_refs = {}
+
+        # The paths watched for each watched node, by node path.
+        self._watching = {}
+
+        # Pipe used to wake the event thread when closing.
+        (self._wake_r, self._wake_w) = os.pipe()
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run,
+                name='cachefs-inotify')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def watch(self, node):
+        with self._lock:
+            if self._closed:
+                return False
+            elif node._watched:
+                return True
+
+            paths = []
+            self._watching[node.abs_path] = paths
+            try:
+                for path in _ancestors(node.dir_name):
+                    self._add_watch(path)
+                    paths.append(path)
+                try:
+                    self._add_watch(node.abs_path)
+                    paths.append(node.abs_path)
+                except OSError as e:
+                    if e.errno != errno.ENOTDIR:
+                        raise
+            except OSError:
+                # Out of watches, or the node has gone; rely on expiry.
+                self._release(node.abs_path)
+                return False
+
+            # Anything cached before now may have changed unseen.
+            node.invalidate()
+            node._watched = True
+            return True
+
+    def unwatch(self, node):
+        with self._lock:
+            if node.abs_path not in self._watching:
+                return
+            # The data cached whilst watched was current until now, and
+            # now expires as per its retrieval time.
+            node._watched = False
+            self._release(node.abs_path)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            os.write(self._wake_w, b'x')
+
+        self._thread.join()
+        with self._lock:
+            self._forget(lambda path : True)
+            self._watching.clear()
+        for fd in (self._fd, self._wake_r, self._wake_w):
+            os.close(fd)
+
+    def _add_watch(self, path):
+        '''
+        Watch the directory at path, or count another user of its watch.
+        '''
+        if path not in self._path_wd:
+            wd = self._libc.inotify_add_watch(self._fd, _fsencode(path),
+                    _WATCH_MASK)
+            if wd < 0:
+                raise _last_error()
+            self._wd_paths.setdefault(wd, set()).add(path)
+            self._path_wd[path] = wd
+        self._path_refs[path] = self._path_refs.get(path, 0) + 1
+
+    def _remove_watch(self, path):
+        '''
+        Stop watching the directory at path.  The watch itself is removed
+        once no other path uses it.
+        '''
+        wd = self._path_wd.pop(path, None)
+        self._path_refs.pop(path, None)
+        if wd is None:
+            return
+        paths = self._wd_paths.get(wd)
+        if paths is not None:
+            paths.discard(path)
+            if paths:
+                return
+            del self._wd_paths[wd]
+        # The watch may already be gone; IN_IGNORED for it is dropped.
+        self._libc.inotify_rm_watch(self._fd, wd)
+
+    def _release(self, abs_path):
+        '''
+        Drop the watches held for the node at abs_path, unless still needed
+        by other nodes.
+        '''
+        for path in self._watching.pop(abs_path, ()):
+            refs = self._path_refs.get(path, 0) - 1
+            if refs > 0:
+                self._path_refs[path] = refs
+            else:
+                self._remove_watch(path)
+
+    def _forget(self, match):
+        '''
+        Drop the watches on directories whose path satisfies "match", and
+        return the nodes inside them to time-based expiry.
+        '''
+        paths = set([path for path in self._path_wd if match(path)])
+        if not paths:
+            return
+
+        for node in _Node.all_nodes():
+            watching = self._watching.get(node.abs_path)
+            if watching and not paths.isdisjoint(watching):
+                self._release(node.abs_path)
+                node._watched = False
+                node.invalidate()
+
+        for path in paths:
+            self._remove_watch(path)
+
+    def _invalidate(self, path):
+        node = _Node.find_node(path)
+        if node is not None:
+            node.invalidate()
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # Events were lost, so nothing watched can be trusted.
+            for node in _Node.all_nodes():
+                if node._watched:
+                    node.invalidate()
+            return
+
+        dir_paths = self._wd_paths.get(wd)
+        if dir_paths is None:
+            return
+
+        # The same directory, through each path it was watched by.
+        for dir_path in list(dir_paths):
+            if name:
+                path = os.path.join(dir_path, name)
+                self._invalidate(path)
+                if mask & _LISTING_EVENTS:
+                    self._invalidate(dir_path)
+            else:
+                path = dir_path
+                self._invalidate(path)
+
+            if mask & (_GONE_EVENTS | IN_IGNORED):
+                # Anything watched at or below this path is no longer
+                # there.
+                prefix = os.path.join(path, '')
+                self._forget(lambda p : (p == path) \
+                        or p.startswith(prefix))
+
+    def _run(self):
+        while True:
+            readable = select.select([self._fd, self._wake_r], [], [])[0]
+            if self._wake_r in readable:
+                return
+
+            try:
+                data = os.read(self._fd, 65536)
+            except OSError as e:  # pragma: no cover
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    continue
+                raise
+
+            with self._lock:
+                for (wd, mask, name) in _parse_events(data):
+                    self._handle(wd, mask, name)
+
+
+def _ancestors(dir_name):
+    '''
+    Return the directory dir_name and those above it, up to the root, as
+    named and as resolved through any symbolic links.
+    '''
+    paths = []
+    for path in (dir_name, os.path.realpath(dir_name)):
+        while path not in paths:
+            paths.append(path)
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+    return paths
+
+
+def _parse_events(data):
+    '''
+    Split a buffer read from an inotify descriptor into (wd, mask, name)
+    tuples.
+    '''
+    offset = 0
+    while offset < len(data):
+        (wd, mask, cookie, length) = _EVENT.unpack_from(data, offset)
+        offset += _EVENT.size
+        name = data[offset:offset+length].rstrip(b'\0')
+        offset += length
+        yield (wd, mask, _fsdecode(name))
+
+
+def _load_libc():
+    '''
+    Load the C library, ensuring it provides inotify.
+    '''
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        libc.inotify_rm_watch
+    except (ImportError, OSError, AttributeError):
+        raise OSError(errno.ENOSYS, 'inotify is not available')
+    return libc
+
+
+def _last_error():
+    import ctypes
+    err = ctypes.get_errno()
+    return OSError(err, os.strerror(err))
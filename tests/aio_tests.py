@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Cached file-system utility library
+# (C) 2016 VRT Systems
+#
+# vim: set ts=4 sts=4 et tw=78 sw=4:
+
+from nose.plugins.skip import SkipTest
+import cachefs
+import os
+import sys
+import stat
+import time
+
+from .utils import TempDirTestCase
+
+def run(coro_fn, *args):
+    '''
+    Run a coroutine function to completion on a new event loop.
+    '''
+    if sys.version_info < (3, 5):
+        raise SkipTest()
+    import asyncio
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro_fn(*args))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+def make_afs():
+    from cachefs.aio import AsyncCacheFs
+    return AsyncCacheFs(cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0))
+
+class TestAsyncCacheFs(TempDirTestCase):
+    def test_cache_typeerror(self):
+        if sys.version_info < (3, 5):
+            raise SkipTest()
+        from cachefs.aio import AsyncCacheFs
+        try:
+            AsyncCacheFs('bogga')
+            assert False, 'It accepted a string'
+        except TypeError:
+            pass
+
+    def test_stat(self):
+        afs = make_afs()
+        st = run(afs.stat, self.temp_dir.file_a)
+        assert stat.S_ISREG(st.st_mode), 'Not a regular file'
+
+        # Once cached, the same result comes back.
+        assert run(afs.stat, self.temp_dir.file_a) is st
+
+    def test_does_not_exist(self):
+        afs = make_afs()
+        try:
+            run(afs.node, os.path.join(self.temp_dir.tempdir, 'nonexistant'))
+            assert False, 'We got a file that does not exist'
+        except KeyError:
+            pass
+
+    def test_hits_counted_and_purged(self):
+        afs = make_afs()
+        cache = afs.cache
+        run(afs.node, self.temp_dir.file_a)
+        run(afs.node, self.temp_dir.file_a)
+        counters = cache.stats.snapshot()['counters']
+        assert counters['hits'] == 1, 'Counters: %r' % counters
+        assert counters['misses'] == 1, 'Counters: %r' % counters
+
+        # Hits poll the scheduler, so expired nodes are still purged.
+        from cachefs.aio import AsyncCacheFs
+        cache = cachefs.CacheFs(cache_expiry=0.2, stat_expiry=60.0)
+        afs = AsyncCacheFs(cache)
+        run(afs.node, self.temp_dir.file_b)
+        run(afs.node, self.temp_dir.file_a)
+        time.sleep(0.3)
+        run(afs.node, self.temp_dir.file_a)
+        assert self.temp_dir.file_b not in cache._nodes, 'Not purged'
+
+    def test_coalesced(self):
+        afs = make_afs()
+        def both():
+            import asyncio
+            return asyncio.gather(afs.node(self.temp_dir.file_b),
+                    afs.node(self.temp_dir.file_b))
+        (n1, n2) = run(both)
+        assert n1 is n2, 'Different nodes returned'
+        assert not afs._inflight, 'Fetch still in flight'
+
+    def test_listdir(self):
+        afs = make_afs()
+        children = run(afs.listdir, self.temp_dir.dir_subdir)
+        assert 'b' in children
+
+    def test_find(self):
+        afs = make_afs()
+        afs.FIND_BATCH = 2
+        results = afs.find(self.temp_dir.tempdir)
+        assert results.__aiter__() is results
+
+        found = []
+        while True:
+            try:
+                found.append(run(results.__anext__).abs_path)
+            except StopAsyncIteration:
+                break
+        assert set(found) == self.temp_dir.all_files, 'A file was missed'
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Cached file-system utility library
+# (C) 2016 VRT Systems
+#
+# vim: set ts=4 sts=4 et tw=78 sw=4:
+
+import cachefs
+from cachefs.backend import MemoryBackend
+from cachefs.watcher import Watcher
+import errno
+import stat
+
+from .utils import TempDirTestCase
+
+
+def make_tree():
+    backend = MemoryBackend()
+    backend.mkdir('/a')
+    backend.mkdir('/a/b')
+    backend.write('/a/x', b'hello')
+    backend.write('/a/b/y', b'')
+    backend.symlink('b/y', '/a/link')
+    backend.symlink('/a/b', '/dirlink')
+    return backend
+
+
+class TestMemoryBackend(TempDirTestCase):
+    def test_calls(self):
+        backend = make_tree()
+        assert stat.S_ISDIR(backend.lstat('/a').st_mode)
+        assert backend.lstat('/a/x').st_size == 5, 'Wrong size'
+        assert stat.S_ISLNK(backend.lstat('/a/link').st_mode)
+        assert stat.S_ISREG(backend.lstat('/dirlink/y').st_mode), \
+                'Link to directory not followed'
+        assert backend.listdir('/a') == ['b', 'link', 'x']
+        assert backend.readlink('/a/link') == 'b/y'
+        assert backend.realpath('/a/link') == '/a/b/y'
+        assert backend.realpath('/dirlink/../x') == '/a/x'
+
+        entries = dict((e.name, e) for e in backend.scandir('/a'))
+        assert entries['b'].is_dir()
+        assert entries['x'].is_file()
+        assert entries['link'].is_symlink()
+        assert entries['link'].is_file(), 'Link not followed'
+        assert not entries['link'].is_file(follow_symlinks=False)
+        assert entries['x'].path == '/a/x'
+
+    def test_errors(self):
+        backend = make_tree()
+        for (fn, args, err) in (
+                (backend.lstat, ('/missing',), errno.ENOENT),
+                (backend.listdir, ('/a/x',), errno.ENOTDIR),
+                (backend.readlink, ('/a/x',), errno.EINVAL),
+                (backend.mkdir, ('/a/b',), errno.EEXIST),
+                (backend.write, ('/a/b',), errno.EISDIR),
+                (backend.remove, ('/a',), errno.ENOTEMPTY),
+                (backend.mkdir, ('/missing/c',), errno.ENOENT)):
+            try:
+                fn(*args)
+                assert False, '%s%r did not fail' % (fn.__name__, args)
+            except OSError as e:
+                assert e.errno == err, '%s%r raised %r' \
+                        % (fn.__name__, args, e)
+
+    def test_changes(self):
+        backend = make_tree()
+        before = backend.lstat('/a').st_mtime_ns
+        backend.remove('/a/x')
+        assert backend.listdir('/a') == ['b', 'link']
+        assert backend.lstat('/a').st_mtime_ns >= before
+        backend.write('/a/b/y', b'abc')
+        assert backend.lstat('/a/b/y').st_size == 3, 'File not replaced'
+
+
+class TestCacheFsBackend(TempDirTestCase):
+    def test_cache(self):
+        backend = make_tree()
+        cache = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0,
+                backend=backend)
+        assert cache['/a/x'].stat.st_size == 5
+        assert cache['/a/link'].target == 'b/y'
+        assert sorted(cache['/a']) == ['b', 'link', 'x']
+        assert cache['/a'].is_dir
+        assert cache['/dirlink/y'].is_file
+        found = sorted(node.abs_path
+                for node in cache['/a'].find(follow_links=True))
+        assert found == ['/a', '/a/b', '/a/b/y', '/a/link', '/a/x'], \
+                'Found %r' % found
+        try:
+            cache['/missing']
+            assert False, 'We got a file that does not exist'
+        except KeyError:
+            pass
+
+    def test_separate_registries(self):
+        backend1 = make_tree()
+        backend2 = MemoryBackend()
+        backend2.mkdir('/a')
+        cache1 = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0,
+                backend=backend1)
+        cache2 = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0,
+                backend=backend2)
+        assert sorted(cache1['/a']) == ['b', 'link', 'x']
+        assert list(cache2['/a']) == [], 'Back-ends share nodes'
+
+    def test_bad_backend(self):
+        try:
+            cachefs.CacheFs(cache_expiry=2.0, stat_expiry=1.0,
+                    backend='bogga')
+            assert False, 'It accepted a string'
+        except TypeError:
+            pass
+
+    def test_watcher_backend(self):
+        try:
+            cachefs.CacheFs(cache_expiry=2.0, stat_expiry=1.0,
+                    watcher=Watcher(), backend=MemoryBackend())
+            assert False, 'It accepted a watcher'
+        except ValueError:
+            pass
+
+    def test_stat_many(self):
+        backend = make_tree()
+        cache = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0,
+                backend=backend)
+        paths = ['/a/x', '/a/link', '/a/b', '/a/missing', '/dirlink']
+        found = cache.stat_many(paths)
+        assert found['/a/x'].st_size == 5
+        assert stat.S_ISLNK(found['/a/link'].st_mode)
+        assert stat.S_ISDIR(found['/a/b'].st_mode)
+        assert found['/a/missing'] is None, 'Missing path was found'
+
+        # Those in /a were all answered by one listing; only /a itself and
+        # /dirlink were looked up.
+        latency = cache.stats.snapshot()['latency']
+        assert latency['children']['count'] == 1, 'Latency: %r' % latency
+        assert latency['stat']['count'] == 2, 'Latency: %r' % latency
@@ -0,0 +1,470 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Cached file-system utility library
+# (C) 2016 VRT Systems
+#
+# vim: set ts=4 sts=4 et tw=78 sw=4:
+
+"""
+Benchmarks for the cache's hot paths, run over a synthetic tree:
+
+    python -m tests.benchmark [--width W] [--depth D] [--files F]
+            [--output results.json] [--compare baseline.json]
+
+For each benchmark this reports operations per second (best of --repeat
+runs), file system calls per operation and the peak memory allocated whilst
+running (where tracemalloc is available), in total and per operation.  The
+node_memory benchmark thus gives the memory held by each cached node.
+Results may be written as JSON, and compared against those of an earlier run
+to spot regressions.
+"""
+
+import argparse
+import copy
+import json
+import os
+import platform
+import sys
+import threading
+import time
+import weakref
+
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    tracemalloc = None
+
+import cachefs
+from cachefs import backend
+from cachefs.intnode import _Node
+
+from .utils import TreeTempdir
+
+
+class SyscallCounter(object):
+    '''
+    Count the file system calls made by the cache, by wrapping the methods
+    of the default back-end.
+    '''
+
+    def __init__(self, fs=None):
+        self.count = 0
+        self._fs = fs or backend._LOCAL
+        self._saved = []
+
+    def _wrap(self, obj, name):
+        fn = getattr(obj, name)
+        def _counted(*args, **kwargs):
+            self.count += 1
+            return fn(*args, **kwargs)
+        self._saved.append((obj, name))
+        setattr(obj, name, _counted)
+
+    def __enter__(self):
+        self.count = 0
+        for name in ('lstat', 'scandir', 'listdir', 'readlink'):
+            self._wrap(self._fs, name)
+        return self
+
+    def __exit__(self, *exc_info):
+        while self._saved:
+            (obj, name) = self._saved.pop()
+            delattr(obj, name)
+
+
+# Times each worker thread looks up every node in the registry benchmarks.
+REGISTRY_ROUNDS = 4
+
+
+class LockedRegistry(object):
+    '''
+    The node registry as it was before being sharded: one dictionary, with
+    one lock taken for every look-up.  This is kept for comparison; nodes
+    are otherwise created as by _Node.get_node.
+    '''
+
+    def __init__(self, fs=None):
+        self.fs = fs or backend._LOCAL
+        self.nodes = weakref.WeakValueDictionary()
+        self.lock = threading.Lock()
+
+    def get_node(self, abs_path):
+        with self.lock:
+            node = self.nodes.get(abs_path)
+            if node is None:
+                node = _Node(abs_path, self.fs)
+                node._seed()
+                self.nodes[abs_path] = node
+                _Node.stats.incr('created')
+        return node
+
+
+class Benchmarks(object):
+    '''
+    The benchmarks.  Each bench_* method does its set-up, then returns a
+    function to be timed and the number of operations it performs.
+    '''
+
+    def __init__(self, tree, workers, fs=None):
+        self.tree = tree
+        self.workers = workers
+        self.fs = fs
+        self.paths = sorted(tree.all_files)
+        self.dirs = sorted(tree.all_dirs)
+
+        # A warm cache, holding every node in the tree.
+        self.cache = self.new_cache(stat_expiry=3600.0)
+        self.nodes = [self.cache[path] for path in self.paths]
+        for node in self.nodes:
+            node.stat
+
+    def new_cache(self, stat_expiry):
+        return cachefs.CacheFs(cache_expiry=3600.0, stat_expiry=stat_expiry,
+                backend=self.fs)
+
+    def new_registry(self):
+        '''
+        Return the back-end, with an empty registry of back-end nodes.
+        '''
+        fs = copy.copy(self.fs or backend._LOCAL)
+        backend.Backend.__init__(fs)
+        return fs
+
+    def bench_getitem_hit(self):
+        cache = self.cache
+        paths = self.paths
+        def run():
+            for path in paths:
+                cache[path]
+        return (run, len(paths))
+
+    def bench_getitem_miss(self):
+        paths = self.paths
+        def run():
+            # A new cache, so every look-up misses (although the back-end
+            # data may still be current).
+            cache = self.new_cache(stat_expiry=3600.0)
+            for path in paths:
+                cache[path]
+        return (run, len(paths))
+
+    def bench_stat_hit(self):
+        nodes = self.nodes
+        def run():
+            for node in nodes:
+                node.stat
+        return (run, len(nodes))
+
+    def bench_stat_refresh(self):
+        cache = self.new_cache(stat_expiry=0.0)
+        nodes = [cache[path] for path in self.paths]
+        def run():
+            for node in nodes:
+                node.stat
+        return (run, len(nodes))
+
+    def bench_stat_many(self):
+        paths = self.paths
+        workers = self.workers
+        def run():
+            cache = self.new_cache(stat_expiry=0.0)
+            cache.stat_many(paths, workers=workers)
+        return (run, len(paths))
+
+    def bench_iter(self):
+        nodes = [self.cache[path] for path in self.dirs]
+        def run():
+            for node in nodes:
+                list(node)
+        return (run, len(nodes))
+
+    def bench_find(self):
+        cache = self.cache
+        root = self.tree.tempdir
+        def run():
+            for found in cache.find(root):
+                pass
+        return (run, len(self.paths))
+
+    def bench_find_cold(self):
+        root = self.tree.tempdir
+        def run():
+            cache = self.new_cache(stat_expiry=0.0)
+            for found in cache.find(root):
+                pass
+        return (run, len(self.paths))
+
+    def bench_find_parallel(self):
+        root = self.tree.tempdir
+        workers = self.workers
+        def run():
+            cache = self.new_cache(stat_expiry=0.0)
+            for found in cache.find(root, workers=workers):
+                pass
+        return (run, len(self.paths))
+
+    def bench_node_memory(self):
+        paths = self.paths
+        def run():
+            # Fresh back-end nodes (in a registry of their own) and cache
+            # nodes for every path, with their statistics.
+            cache = cachefs.CacheFs(cache_expiry=3600.0,
+                    stat_expiry=3600.0, backend=self.new_registry())
+            for path in paths:
+                cache[path].stat
+        return (run, len(paths))
+
+    def bench_registry_hit(self):
+        fs = self.fs or backend._LOCAL
+        return self._registry_hit(lambda path : _Node.get_node(path, fs))
+
+    def bench_registry_hit_locked(self):
+        registry = LockedRegistry(self.fs)
+        for node in self.nodes:
+            registry.nodes[node.abs_path] = node._node
+        return self._registry_hit(registry.get_node)
+
+    def _registry_hit(self, get_node):
+        # Every worker thread looks up every (existing) node at once.
+        paths = self.paths
+        def lookup():
+            for n in range(REGISTRY_ROUNDS):
+                for path in paths:
+                    get_node(path)
+        def run():
+            self._threaded([lookup] * self.workers)
+        return (run, REGISTRY_ROUNDS * self.workers * len(paths))
+
+    def bench_registry_create(self):
+        registries = []
+        def get_node(path):
+            return _Node.get_node(path, registries[-1])
+        return self._registry_create(get_node,
+                lambda : registries.append(self.new_registry()))
+
+    def bench_registry_create_locked(self):
+        registries = []
+        def get_node(path):
+            return registries[-1].get_node(path)
+        return self._registry_create(get_node,
+                lambda : registries.append(LockedRegistry(self.fs)))
+
+    def _registry_create(self, get_node, new_registry):
+        # The worker threads create nodes for their share of the paths,
+        # in an empty registry, at once.
+        paths = self.paths
+        workers = self.workers
+        def create(share):
+            nodes = [get_node(path) for path in share]
+        def run():
+            self._threaded([lambda n=n : create(paths[n::workers])
+                for n in range(workers)])
+        return (run, len(paths), new_registry)
+
+    def _threaded(self, fns):
+        '''
+        Call each of the functions in a thread of its own, all at once,
+        returning when all have finished.
+        '''
+        threads = [threading.Thread(target=fn) for fn in fns]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def bench_purge(self):
+        paths = self.paths
+        caches = []
+        def run():
+            # Purge a cache where every node has expired.
+            cache = caches.pop()
+            cache._cache_expiry = 0.0
+            cache._purge()
+
+        def setup():
+            cache = self.new_cache(stat_expiry=3600.0)
+            for path in paths:
+                cache[path]
+            caches.append(cache)
+        return (run, len(paths), setup)
+
+    def names(self):
+        return sorted([name[6:] for name in dir(self)
+            if name.startswith('bench_')])
+
+    def run(self, name, repeat, min_time):
+        '''
+        Run the named benchmark, returning its results.  Each of the
+        "repeat" timed runs calls the benchmark for at least "min_time"
+        seconds; the best rate is kept.
+        '''
+        bench = getattr(self, 'bench_%s' % name)()
+        if len(bench) == 3:
+            (fn, ops, setup) = bench
+        else:
+            (fn, ops) = bench
+            setup = lambda : None
+
+        # Warm up, then count the system calls.
+        setup()
+        fn()
+        setup()
+        with SyscallCounter(self.fs) as counter:
+            fn()
+
+        best = 0.0
+        for n in range(repeat):
+            calls = 0
+            elapsed = 0.0
+            while elapsed < min_time:
+                setup()
+                start = time.time()
+                fn()
+                elapsed += time.time() - start
+                calls += 1
+            best = max(best, (ops * calls) / elapsed)
+
+        peak = None
+        if tracemalloc is not None:
+            setup()
+            tracemalloc.start()
+            try:
+                fn()
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        return {
+            'ops':              ops,
+            'ops_per_sec':      best,
+            'syscalls_per_op':  float(counter.count) / ops,
+            'peak_bytes':       peak,
+            'bytes_per_op':     (None if peak is None
+                                    else float(peak) / ops),
+        }
+
+
+def memory_copy(tree):
+    '''
+    Return a MemoryBackend holding a copy of the tree, at the same paths.
+    '''
+    fs = backend.MemoryBackend()
+    path = os.sep
+    for name in tree.tempdir.split(os.sep)[1:]:
+        path = os.path.join(path, name)
+        fs.mkdir(path)
+    for path in sorted(tree.all_files):
+        if path == tree.tempdir:
+            continue
+        elif os.path.isdir(path):
+            fs.mkdir(path)
+        else:
+            with open(path, 'rb') as f:
+                fs.write(path, f.read())
+    return fs
+
+
+def compare(results, baseline, threshold):
+    '''
+    Print the change in each benchmark's rate against a baseline, returning
+    the names of those that have slowed by more than "threshold" (a
+    fraction).
+    '''
+    regressed = []
+    for (name, result) in sorted(results['results'].items()):
+        base = baseline.get('results', {}).get(name)
+        if base is None:
+            print('%-22s (no baseline)' % name)
+            continue
+        ratio = result['ops_per_sec'] / base['ops_per_sec']
+        flag = ''
+        if ratio < (1.0 - threshold):
+            flag = '  REGRESSED'
+            regressed.append(name)
+        memory = ''
+        if base.get('bytes_per_op') and result.get('bytes_per_op'):
+            memory = ', bytes/op %.0f -> %.0f' % (base['bytes_per_op'],
+                    result['bytes_per_op'])
+        print('%-22s %6.2fx ops/sec, syscalls/op %.2f -> %.2f%s%s' % (
+            name, ratio, base['syscalls_per_op'],
+            result['syscalls_per_op'], memory, flag))
+    return regressed
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+            description='Benchmark the cachefs hot paths')
+    parser.add_argument('--width', type=int, default=4,
+            help='Sub-directories per directory')
+    parser.add_argument('--depth', type=int, default=4,
+            help='Levels of sub-directories')
+    parser.add_argument('--files', type=int, default=8,
+            help='Files per directory')
+    parser.add_argument('--workers', type=int, default=4,
+            help='Threads used by the parallel find')
+    parser.add_argument('--repeat', type=int, default=5,
+            help='Timed runs of each benchmark (the best is kept)')
+    parser.add_argument('--min-time', type=float, default=0.2,
+            help='Minimum duration of each timed run, in seconds')
+    parser.add_argument('--only', action='append',
+            help='Run only the named benchmark (may be repeated)')
+    parser.add_argument('--output',
+            help='Write the results to this file, as JSON')
+    parser.add_argument('--compare',
+            help='Compare against results from an earlier --output')
+    parser.add_argument('--threshold', type=float, default=0.1,
+            help='Slow-down (as a fraction) reported as a regression')
+    parser.add_argument('--memory', action='store_true',
+            help='Cache a copy of the tree held in memory, leaving out the '
+                'cost of the system calls')
+    args = parser.parse_args(args)
+
+    tree = TreeTempdir(width=args.width, depth=args.depth,
+            files=args.files)
+    tree.make()
+    try:
+        fs = None
+        if args.memory:
+            fs = memory_copy(tree)
+        benchmarks = Benchmarks(tree, args.workers, fs)
+        results = {
+            'params': {
+                'width':    args.width,
+                'depth':    args.depth,
+                'files':    args.files,
+                'workers':  args.workers,
+                'nodes':    len(tree.all_files),
+                'memory':   args.memory,
+            },
+            'python':   platform.python_version(),
+            'platform': platform.platform(),
+            'results':  {},
+        }
+        for name in (args.only or benchmarks.names()):
+            result = benchmarks.run(name, args.repeat, args.min_time)
+            results['results'][name] = result
+            print('%-22s %12.0f ops/sec %8.2f syscalls/op %10s bytes '
+                    '%8s bytes/op' % (name, result['ops_per_sec'],
+                    result['syscalls_per_op'], result['peak_bytes'],
+                    ('%.0f' % result['bytes_per_op']
+                        if result['bytes_per_op'] is not None else None)))
+    finally:
+        tree.delete()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('params') != results['params']:
+            print('Warning: baseline was run with %r'
+                    % baseline.get('params'))
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
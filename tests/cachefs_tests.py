@@ -7,10 +7,12 @@
 
 import cachefs
 from pyat.sync import SynchronousTaskScheduler
-from .utils import TempDirTestCase, compare_walk
+from .utils import TempDirTestCase, FilesTempdir, compare_walk, race
 import weakref
 import time
 import os
+import gc
+from cachefs.intnode import _Node
 
 class TestCacheFs(TempDirTestCase):
     def test_cachefs_scheduler_typeerror(self):
@@ -71,3 +73,344 @@ class TestCacheFs(TempDirTestCase):
 
         # Check that the reference n2 has gone
         assert n2r() is None, 'Still in cache'
+
+    def test_purge_expiry_heap(self):
+        scheduler = SynchronousTaskScheduler()
+        cache = cachefs.CacheFs(cache_expiry=1.0, stat_expiry=1.0,
+                scheduler=scheduler)
+        n1 = cache[self.temp_dir.tempdir]
+        n2 = cache[self.temp_dir.file_a]
+        assert len(cache._expiry) == 2
+
+        time.sleep(0.5)
+        n2._update_atime()
+        time.sleep(0.6)
+        scheduler.poll()
+
+        # n1 expired, n2 re-filed under its new access time.
+        assert list(cache._nodes.keys()) == [n2.abs_path]
+        assert cache._expiry == [(n2.atime, n2.abs_path)]
+        assert cache._min_atime == n2.atime
+
+    def test_max_nodes(self):
+        cache = cachefs.CacheFs(cache_expiry=300.0, stat_expiry=1.0,
+                max_nodes=2)
+        n1 = cache[self.temp_dir.tempdir]
+        n2 = cache[self.temp_dir.file_a]
+        n1._update_atime()
+        n3 = cache[self.temp_dir.dir_subdir]
+
+        # n2 was least recently used, so should have been evicted.
+        assert set(cache._nodes.keys()) == set([n1.abs_path, n3.abs_path])
+
+    def test_max_bytes(self):
+        cache = cachefs.CacheFs(cache_expiry=300.0, stat_expiry=1.0,
+                max_bytes=1)
+        n1 = cache[self.temp_dir.tempdir]
+        n2 = cache[self.temp_dir.file_a]
+
+        # Only the most recently used node is kept.
+        assert list(cache._nodes.keys()) == [n2.abs_path]
+        assert cache._bytes == n2._size
+
+    def test_evicted_descendants_freed(self):
+        names = ['sub/'] + ['%sf%d' % (d, n) for d in ('', 'sub/')
+                for n in range(5)]
+        with FilesTempdir(*names) as tree:
+            cache = cachefs.CacheFs(cache_expiry=300.0, stat_expiry=60.0,
+                    max_nodes=2)
+            root = cache[tree.tempdir]
+            found = list(root.find())
+            assert len(found) == 12, 'Found %d nodes' % len(found)
+            del found
+            gc.collect()
+
+            # Only the nodes held by the cache (and root) remain; the
+            # listings of the directories do not keep the others alive.
+            alive = [node.abs_path for node in _Node.all_nodes()
+                    if node.abs_path.startswith(tree.tempdir)]
+            assert len(alive) <= 3, 'Nodes still alive: %r' % alive
+
+            # The file types recorded by the listing are still known.
+            node = cache[tree.join('f0')]._node
+            assert node.peek_stat(cache._required_time) is None
+            assert node._file_type is not None, 'File type was lost'
+
+    def test_concurrent_lookups(self):
+        names = ['f%d' % n for n in range(200)]
+        with FilesTempdir(*names) as tree:
+            paths = [tree.join(name) for name in names]
+            cache = cachefs.CacheFs(cache_expiry=300.0, stat_expiry=60.0)
+            results = race(lambda : [cache[path] for path in paths])
+
+            # Every thread got the same node for each path, and each was
+            # added to the cache once.
+            for nodes in results[1:]:
+                for (node, first) in zip(nodes, results[0]):
+                    assert node is first, \
+                            'Two nodes for %s' % node.abs_path
+            assert len(cache._nodes) == len(paths)
+            assert len(cache._expiry) == len(paths), \
+                    'Heap has %d entries' % len(cache._expiry)
+            assert cache._bytes == sum([node._size
+                for node in cache._nodes.values()]), 'Size counted twice'
+
+    def test_max_nodes_valueerror(self):
+        try:
+            cachefs.CacheFs(cache_expiry=2.0, stat_expiry=1.0, max_nodes=0)
+            assert False, 'It accepted a zero limit'
+        except ValueError:
+            pass
+
+    def test_exists_from_listing(self):
+        listed_file = os.path.join(self.temp_dir.tempdir, 'listed')
+        new_file = os.path.join(self.temp_dir.tempdir, 'unlisted')
+        cache = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0)
+        node_dir = cache[self.temp_dir.tempdir]
+        open(listed_file, 'w').write('listed file')
+        try:
+            # Take a listing of the directory.
+            children = set(node_dir)
+
+            # A child in that listing is found without being stat'ed.
+            node = cache[listed_file]
+            assert node._node.peek_stat(cache._required_time) is None, \
+                    'Child was stat\'ed'
+
+            # Whereas a file created since isn't in the listing.
+            open(new_file, 'w').write('new file')
+            try:
+                cache[new_file]
+                assert False, 'Fresh listing was not used'
+            except KeyError:
+                pass
+        finally:
+            for name in (listed_file, new_file):
+                if os.path.exists(name):
+                    os.unlink(name)
+
+    def test_negative_cache(self):
+        with FilesTempdir() as tree:
+            new_file = tree.join('file')
+            cache = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0,
+                    negative_expiry=0.5)
+            try:
+                cache[new_file]
+                assert False, 'We got a file that does not exist'
+            except KeyError:
+                pass
+
+            # Until the entry expires, the file is still reported missing.
+            open(new_file, 'w').write('new file')
+            try:
+                cache[new_file]
+                assert False, 'Negative entry not used'
+            except KeyError:
+                pass
+
+            time.sleep(0.6)
+            assert cache[new_file].abs_path == new_file
+
+    def test_negative_cache_parent_changed(self):
+        with FilesTempdir() as tree:
+            new_file = tree.join('file')
+            cache = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0,
+                    negative_expiry=60.0)
+            node_dir = cache[tree.tempdir]
+            try:
+                cache[new_file]
+                assert False, 'We got a file that does not exist'
+            except KeyError:
+                pass
+
+            # Creating the file changes the parent directory; once that
+            # is seen, the negative entry is dropped.
+            open(new_file, 'w').write('new file')
+            node_dir._node.get_stat(time.time() + 60.0)
+            assert cache[new_file].abs_path == new_file
+
+    def test_negative_cache_parent_listed(self):
+        with FilesTempdir() as tree:
+            new_file = tree.join('cfg')
+            cache = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0,
+                    negative_expiry=60.0)
+            # The parent's statistics aren't cached when the miss is seen.
+            try:
+                cache[new_file]
+                assert False, 'We got a file that does not exist'
+            except KeyError:
+                pass
+
+            # A listing of the parent taken since shows the file.
+            open(new_file, 'w').write('new file')
+            assert 'cfg' in set(cache[tree.tempdir])
+            assert cache.stat_many([new_file])[new_file] is not None, \
+                    'Negative entry used despite the listing'
+            assert cache[new_file].abs_path == new_file
+
+    def test_prefetch(self):
+        with FilesTempdir('sub/', 'x', 'sub/y') as tree:
+            tempdir = tree.tempdir
+            subdir = tree.join('sub')
+            for workers in (None, 4):
+                cache = cachefs.CacheFs(cache_expiry=60.0,
+                        stat_expiry=60.0)
+                seen = []
+                count = cache.prefetch([tempdir, tree.join('missing')],
+                    workers=workers,
+                    progress=lambda node, count : seen.append(node.abs_path))
+                assert count == 4, 'Fetched %d nodes' % count
+                assert sorted(seen) == sorted([tempdir, subdir]), \
+                        'Progress reported %r' % seen
+
+                since_time = cache._required_time
+                for path in tree.all_files:
+                    node = cache._nodes.get(path)
+                    assert node is not None, '%s not cached' % path
+                    assert node._node.peek_stat(since_time) is not None, \
+                            '%s not stat\'ed' % path
+
+    def test_prefetch_limits(self):
+        with FilesTempdir('sub/', 'sub/y') as tree:
+            cache = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0)
+            count = cache.prefetch(tree.tempdir, recursive=False)
+            assert count == 2, 'Fetched %d nodes' % count
+            assert tree.join('sub', 'y') not in cache._nodes, \
+                    'Sub-directory was warmed'
+
+            for workers in (None, 4):
+                cache = cachefs.CacheFs(cache_expiry=60.0,
+                        stat_expiry=60.0)
+                count = cache.prefetch(tree.tempdir, workers=workers,
+                        timeout=0)
+                assert count == 1, 'Fetched %d nodes' % count
+
+    def test_stat_many(self):
+        with FilesTempdir('sub/', 'x', 'sub/y') as tree:
+            tempdir = tree.tempdir
+            subdir = tree.join('sub')
+            file_x = tree.join('x')
+            file_y = tree.join('sub', 'y')
+            missing = tree.join('missing')
+            open(file_x, 'w').write('x')
+            open(file_y, 'w').write('yy')
+            paths = [tempdir, subdir, file_x, file_y, missing,
+                    os.path.join(missing, 'z')]
+            for workers in (None, 4):
+                cache = cachefs.CacheFs(cache_expiry=60.0,
+                        stat_expiry=60.0)
+                found = cache.stat_many(paths, workers=workers)
+                assert sorted(found) == sorted(paths), \
+                        'Got paths %r' % sorted(found)
+                assert found[file_x].st_size == 1
+                assert found[file_y].st_size == 2
+                assert found[missing] is None, 'Missing path was found'
+                assert found[os.path.join(missing, 'z')] is None
+                assert found[tempdir] == os.lstat(tempdir)
+                assert cache[file_y].stat is found[file_y], \
+                        'Statistics not cached'
+
+                # Now answered from the cache.
+                cache.stats.reset()
+                found = cache.stat_many([file_x, file_y])
+                counters = cache.stats.snapshot()['counters']
+                assert counters == {'hits': 2}, 'Counters: %r' % counters
+
+            # Missing children are found from a current listing.
+            cache = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0)
+            list(cache[tempdir])
+            cache.stats.reset()
+            found = cache.stat_many([missing, tree.join('w')])
+            assert found == {missing: None, tree.join('w'): None}, \
+                    'Got %r' % found
+            snapshot = cache.stats.snapshot()
+            assert 'stat' not in snapshot['latency'], 'Paths were stat\'ed'
+            assert snapshot['counters']['not_found'] == 2
+
+    def test_save_load(self):
+        with FilesTempdir('sub/', 'other/', 'x', 'sub/y') as tree, \
+                FilesTempdir() as snap_dir:
+            tempdir = tree.tempdir
+            subdir = tree.join('sub')
+            other = tree.join('other')
+            file_z = tree.join('sub', 'z')
+            snap = snap_dir.join('snapshot')
+
+            # Listings taken soon after a change can't be validated later.
+            time.sleep(1.5)
+            cache = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0)
+            found = set([n.abs_path for n in cache.find(tempdir)])
+            assert cache.save(snap) == 5, 'Not all nodes saved'
+
+            # Forget everything, as if restarted.
+            del cache
+            gc.collect()
+            assert _Node.find_node(tempdir) is None, 'Nodes still held'
+
+            # Change one directory whilst "stopped".
+            open(file_z, 'w').write('z')
+
+            cache = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0)
+            assert cache.load(snap) == 5, 'Not all nodes loaded'
+            top = cache[tempdir]._node
+            sub = cache[subdir]._node
+            assert top.peek_children(time.time()) is None, \
+                    'Loaded listing trusted without validation'
+            top_children = top._entries
+            sub_children = sub._entries
+            other_children = cache[other]._node._entries
+
+            found_again = set([n.abs_path for n in cache.find(tempdir)])
+            assert found_again == found | set([file_z]), \
+                    'Unexpected result %r' % found_again
+            assert top._entries is top_children, \
+                    'Unchanged directory was listed again'
+            assert cache[other]._node._entries is other_children, \
+                    'Unchanged directory was listed again'
+            assert sub._entries is not sub_children, \
+                    'Changed directory was not listed again'
+
+            open(snap, 'wb').write(b'bogus')
+            try:
+                cache.load(snap)
+                assert False, 'Loaded a bogus snapshot'
+            except ValueError:
+                pass
+
+    def test_stat_many_root(self):
+        cache1 = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0)
+        cache2 = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0)
+        # The two caches share the listing of the root.
+        list(cache1['/'])
+        found = cache2.stat_many(['/'])
+        assert found['/'] is not None, 'The root was not found'
+
+    def test_load_deleted(self):
+        with FilesTempdir('x') as tree, FilesTempdir() as snap_dir:
+            file_x = tree.join('x')
+            snap = snap_dir.join('snapshot')
+            cache = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0)
+            assert cache[file_x].is_file
+            cache.save(snap)
+            del cache
+            gc.collect()
+
+            # Delete the file whilst "stopped".
+            os.unlink(file_x)
+            cache = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0)
+            cache.load(snap)
+            try:
+                cache[file_x]
+                assert False, 'Deleted file found after load'
+            except KeyError:
+                pass
+
+    def test_save_load_root(self):
+        with FilesTempdir() as snap_dir:
+            snap = snap_dir.join('snapshot')
+            cache = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0)
+            cache['/']
+            saved = cache.save(snap)
+            cache = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0)
+            assert cache.load(snap) == saved, 'Not all nodes loaded'
+            assert cache['/'].is_dir
@@ -6,14 +6,15 @@
 # vim: set ts=4 sts=4 et tw=78 sw=4:
 
 from nose.plugins.skip import SkipTest
-from cachefs import intnode
+from cachefs import intnode, backend
 import os
 import weakref
 import tempfile
 import stat
 import time
+import threading
 
-from .utils import TempDirTestCase
+from .utils import TempDirTestCase, FilesTempdir, race
 
 class TestIntNode(TempDirTestCase):
     def test_is_singleton(self):
@@ -30,6 +31,23 @@ class TestIntNode(TempDirTestCase):
         del n
         assert nr() is None, 'Node still exists'
 
+    def test_concurrent_get_node(self):
+        # Many threads race to create the same nodes, spread across the
+        # shards of a fresh registry; each path must get just one node.
+        fs = backend.LocalBackend()
+        paths = [os.path.join(self.temp_dir.tempdir, 'n%d' % n)
+                for n in range(2000)]
+        shards = set([hash(p) % fs._SHARDS for p in paths])
+        assert len(shards) > 1, 'Paths all in one shard'
+
+        results = race(lambda : [intnode._Node.get_node(p, fs)
+            for p in paths])
+        for nodes in results[1:]:
+            for (node, first) in zip(nodes, results[0]):
+                assert node is first, 'Duplicate node for %s' % node.abs_path
+        assert sorted(n.abs_path for n in intnode._Node.all_nodes(fs)) \
+                == sorted(paths), 'Registry holds duplicates'
+
     def test_names(self):
         cwd = os.getcwd()
         n = intnode._Node.get_node(self.temp_dir.tempdir)
@@ -102,3 +120,146 @@ class TestIntNode(TempDirTestCase):
                     'Cached data not refreshed.'
         finally:
             os.unlink(child_file)
+
+    def test_lazy_allocation(self):
+        node = intnode._Node.get_node(self.temp_dir.file_a)
+        assert node._lk is None, 'Lock created up front'
+
+        # Peeking never needs the lock.
+        now = time.time()
+        node.peek_stat(now)
+        assert node._lk is None, 'Lock created by peeking'
+
+        node.get_stat(now)
+        lock = node._lk
+        assert lock is not None, 'Lock not created'
+        node.get_stat(now + 300.0)
+        assert node._lk is lock, 'Lock replaced'
+
+        # Files never allocate listings, even when their parent is listed.
+        intnode._Node.get_node(self.temp_dir.tempdir).get_children(now)
+        node.get_file_type(now)
+        assert node._children is None, 'File allocated a child set'
+        assert node._entries is None, 'File allocated child entries'
+
+    def test_child_file_type(self):
+        if backend.scandir is None:
+            # No scandir() available, types come from lstat().
+            raise SkipTest()
+
+        now = time.time()
+        node = intnode._Node.get_node(self.temp_dir.tempdir)
+        children = node.get_children(now)
+        assert 'a' in children
+
+        # The child should know its type without having been stat'ed.
+        child = intnode._Node.get_node(self.temp_dir.file_a)
+        assert child._file_type == stat.S_IFREG, 'File type not recorded'
+        assert child.get_file_type(now) == stat.S_IFREG, \
+                'Wrong file type reported'
+
+        subdir = intnode._Node.get_node(self.temp_dir.dir_subdir)
+        assert subdir.get_file_type(now) == stat.S_IFDIR, \
+                'Wrong file type reported'
+
+    def test_child_cache_validate(self):
+        # Generate a directory that was last modified in the past.
+        child_dir = os.path.join(self.temp_dir.tempdir, 'validated')
+        child_file = os.path.join(child_dir, 'testfile')
+        os.mkdir(child_dir)
+        try:
+            past = time.time() - 60.0
+            os.utime(child_dir, (past, past))
+            # Let the change time settle outside the racy window.
+            time.sleep(intnode._RACY_WINDOW + 0.1)
+            now = time.time()
+
+            node = intnode._Node.get_node(child_dir)
+            children_1 = node.get_children(now, validate=True)
+
+            # Pretending it's 5 minutes later, the listing should be
+            # revalidated rather than read again.
+            children_2 = node.get_children(now + 300.0, validate=True)
+            assert children_1 is children_2, 'Listing was re-read'
+
+            # Create a child, the listing should now be re-read.
+            open(child_file,'w').write('new file')
+            children_3 = node.get_children(now + 600.0, validate=True)
+            assert (children_3 - children_1) == set(['testfile']), \
+                    'Cached data not refreshed.'
+        finally:
+            if os.path.exists(child_file):
+                os.unlink(child_file)
+            os.rmdir(child_dir)
+
+    def test_child_cache_validate_fresh_stat(self):
+        with FilesTempdir() as tree:
+            past = time.time() - 60.0
+            os.utime(tree.tempdir, (past, past))
+            time.sleep(intnode._RACY_WINDOW + 0.1)
+
+            node = intnode._Node.get_node(tree.tempdir)
+            children_1 = node.get_children(time.time(), validate=True)
+            listed = node._children_last
+
+            # The statistics are refreshed, then the directory changes
+            # whilst they're still current.
+            time.sleep(0.05)
+            node.get_stat(time.time())
+            open(tree.join('testfile'), 'w').write('new file')
+
+            # The expired listing must not be vouched for by the cached
+            # statistics.
+            children_2 = node.get_children(listed + 0.01, validate=True)
+            assert (children_2 - children_1) == set(['testfile']), \
+                    'Stale listing was revalidated'
+
+    def test_child_cache_validate_stale_target(self):
+        if not hasattr(os, 'symlink'):
+            raise SkipTest('symlinks not supported')
+        with FilesTempdir() as tree:
+            child_link = tree.join('link')
+            os.symlink('a', child_link)
+            link = intnode._Node.get_node(child_link)
+            assert link.get_target(time.time()) == 'a'
+
+            # Replace the link, then list the directory once the change
+            # has left the racy window.
+            os.unlink(child_link)
+            os.symlink('b', child_link)
+            time.sleep(intnode._RACY_WINDOW + 0.1)
+            node = intnode._Node.get_node(tree.tempdir)
+            node.get_children(time.time(), validate=True)
+            listed = node._children_last
+
+            # Revalidating the listing must not vouch for the target read
+            # before it.
+            time.sleep(0.05)
+            node.get_children(listed + 0.001, validate=True)
+            assert node._children_last > listed, 'Listing not revalidated'
+            assert link.get_target(listed + 0.001) == 'b', \
+                    'Stale link target vouched for'
+
+    def test_stat_single_flight(self):
+        now = time.time()
+        node = intnode._Node.get_node(self.temp_dir.file_b)
+        node.get_stat(now)
+
+        # Pretend a refresh is in progress in another thread.
+        results = []
+        fetched = object()
+        with node._lock:
+            node._busy |= intnode._BUSY_STAT
+            waiter = threading.Thread(target=lambda : \
+                    results.append(node.get_stat(now + 300.0)))
+            waiter.start()
+            time.sleep(0.1)
+
+            # Complete the "refresh".
+            node._stat = fetched
+            node._last_stat = time.time()
+            node._busy &= ~intnode._BUSY_STAT
+        waiter.join()
+
+        # The waiter should have taken our result rather than refreshing.
+        assert results == [fetched], 'Statistics refreshed again'
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Cached file-system utility library
+# (C) 2016 VRT Systems
+#
+# vim: set ts=4 sts=4 et tw=78 sw=4:
+
+import cachefs
+import os
+import stat
+
+from .utils import TempDirTestCase, FilesTempdir
+
+class TestMatch(TempDirTestCase):
+    def test_match_name(self):
+        cache = cachefs.CacheFs(cache_expiry=2.0, stat_expiry=1.0)
+        found = set([n.abs_path for n in cache.find(self.temp_dir.tempdir,
+            match=cachefs.Match(name='a'))])
+        expected = set([self.temp_dir.file_a])
+        if hasattr(os, 'symlink'):
+            expected.add(self.temp_dir.link_a)
+        assert found == expected, 'Unexpected result %r' % found
+
+    def test_match_file_type(self):
+        cache = cachefs.CacheFs(cache_expiry=2.0, stat_expiry=1.0)
+        for file_type in ('f', stat.S_IFREG, ['f']):
+            found = set([n.abs_path for n in cache.find(
+                self.temp_dir.tempdir,
+                match=cachefs.Match(file_type=file_type))])
+            assert found == set([self.temp_dir.file_a,
+                self.temp_dir.file_b]), 'Unexpected result %r' % found
+
+    def test_match_and_predicate(self):
+        cache = cachefs.CacheFs(cache_expiry=2.0, stat_expiry=1.0)
+        found = set([n.abs_path for n in cache.find(self.temp_dir.tempdir,
+            predicate=lambda n : n.dir_name == self.temp_dir.dir_subdir,
+            match=cachefs.Match(file_type='f'))])
+        assert found == set([self.temp_dir.file_b]), \
+                'Unexpected result %r' % found
+
+    def test_match_prune(self):
+        cache = cachefs.CacheFs(cache_expiry=2.0, stat_expiry=1.0)
+        for workers in (None, 4):
+            found = set([n.abs_path for n in cache.find(
+                self.temp_dir.tempdir, workers=workers,
+                match=cachefs.Match(prune=['subdir', 'to_*']),
+                follow_links=True)])
+            assert self.temp_dir.dir_subdir in found, \
+                    'Pruned directory not reported'
+            assert self.temp_dir.file_b not in found, \
+                    'Pruned directory was searched'
+            assert self.temp_dir.file_a in found, 'A file was missed'
+
+    def test_match_size_mtime(self):
+        with FilesTempdir('small') as tree:
+            tempdir = tree.tempdir
+            small = tree.join('small')
+            large = tree.join('large')
+            open(large, 'w').write('x' * 1000)
+            os.utime(small, (1000, 1000))
+
+            cache = cachefs.CacheFs(cache_expiry=2.0, stat_expiry=1.0)
+            found = set([n.abs_path for n in cache.find(tempdir,
+                match=cachefs.Match(file_type='f', min_size=10))])
+            assert found == set([large]), 'Unexpected result %r' % found
+
+            found = set([n.abs_path for n in cache.find(tempdir,
+                match=cachefs.Match(file_type='f', max_mtime=2000))])
+            assert found == set([small]), 'Unexpected result %r' % found
@@ -12,8 +12,19 @@ import weakref
 import tempfile
 import stat
 import time
+import sys
 
-from .utils import TempDirTestCase, compare_walk
+from .utils import TempDirTestCase, FilesTempdir, compare_walk
+
+def make_loops(tree):
+    '''
+    Create symbolic links in tree that loop: 'self' to itself, and 'loop_1'
+    and 'loop_2' to each other.  Returns their paths.
+    '''
+    loops = [tree.join(name) for name in ('self', 'loop_1', 'loop_2')]
+    for (path, target) in zip(loops, ('self', 'loop_2', 'loop_1')):
+        os.symlink(target, path)
+    return loops
 
 class TestNode(TempDirTestCase):
     HAS_LINKS = getattr(os, 'symlink')
@@ -329,3 +340,125 @@ class TestNode(TempDirTestCase):
         # We should just see everything except the top-level directory.
         assert file_names == \
                 (self.temp_dir.all_files - set([self.temp_dir.tempdir]))
+
+    def test_node_find_parallel(self):
+        cache = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0)
+        found_names = set([found.abs_path for found in
+                cache.find(self.temp_dir.tempdir, workers=4)])
+
+        assert found_names == self.temp_dir.all_files, 'A file was missed'
+
+    def test_node_find_parallel_depth(self):
+        cache = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0)
+        node = cache[self.temp_dir.tempdir]
+        file_names = set([n.abs_path for n in node.find(min_depth=1,
+            max_depth=1, workers=4)])
+        # We should just see the children of the top-level directory.
+        assert file_names == set([c.abs_path for c in node.values()])
+
+    def test_node_find_parallel_ordered(self):
+        cache = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0)
+        node = cache[self.temp_dir.tempdir]
+        for depth_first in (False, True):
+            expected = list(node.find(depth_first=depth_first))
+            found = list(node.find(depth_first=depth_first, workers=4,
+                ordered=True))
+            assert found == expected, 'Order does not match'
+
+    def test_node_find_deep(self):
+        # A tree deeper than the recursion limit should still be searched.
+        depth = sys.getrecursionlimit() + 10
+        top = tempfile.mkdtemp()
+        made = [top]
+        try:
+            for n in range(depth):
+                made.append(os.path.join(made[-1], 'd'))
+                os.mkdir(made[-1])
+
+            cache = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0)
+            for depth_first in (False, True):
+                found = list(cache.find(top, depth_first=depth_first))
+                assert len(found) == depth + 1, 'A directory was missed'
+        finally:
+            for path in reversed(made):
+                os.rmdir(path)
+
+    def test_node_find_follow_links(self):
+        if not self.HAS_LINKS:
+            raise SkipTest
+        cache = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0)
+        for workers in (None, 4):
+            # 'to_subdir' and 'subdir/top' lead back into directories
+            # already searched, so nothing should be found twice.
+            found = [n.abs_path for n in cache.find(self.temp_dir.tempdir,
+                follow_links=True, workers=workers)]
+            assert len(found) == len(set(found)), 'A file was found twice'
+            assert set(found) == self.temp_dir.all_files, 'A file was missed'
+
+    def test_symlink_abs_final_target_matches_realpath(self):
+        if not self.HAS_LINKS:
+            raise SkipTest
+
+        loop_1 = os.path.join(self.temp_dir.tempdir, 'loop_1')
+        loop_2 = os.path.join(self.temp_dir.tempdir, 'loop_2')
+        os.symlink('loop_2', loop_1)
+        os.symlink('loop_1', loop_2)
+        try:
+            cache = cachefs.CacheFs(cache_expiry=2.0, stat_expiry=1.0)
+            for path in (self.temp_dir.link_top, self.temp_dir.link_to_a,
+                    os.path.join(self.temp_dir.link_top, 'subdir', 'top',
+                        'to_subdir', '..', 'a'),
+                    os.path.join(self.temp_dir.link_broken, 'x'),
+                    loop_1):
+                assert cache._realpath(path) == os.path.realpath(path), \
+                        'Mismatch for %r' % path
+        finally:
+            os.unlink(loop_1)
+            os.unlink(loop_2)
+
+    def test_symlink_abs_final_target_loop(self):
+        if not self.HAS_LINKS:
+            raise SkipTest
+
+        with FilesTempdir() as tree:
+            loops = make_loops(tree)
+            cache = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0)
+            for path in loops:
+                assert cache[path].abs_final_target \
+                        == os.path.realpath(path), 'Mismatch for %r' % path
+            path = os.path.join(loops[1], 'x')
+            assert cache._realpath(path) == os.path.realpath(path), \
+                    'Mismatch for %r' % path
+
+    def test_node_find_link_loop(self):
+        if not self.HAS_LINKS:
+            raise SkipTest
+
+        with FilesTempdir() as tree:
+            loops = make_loops(tree)
+            cache = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0)
+            for path in loops[:2]:
+                for (follow_links, workers) in ((False, None),
+                        (True, None), (False, 2), (True, 2)):
+                    found = [n.abs_path for n in cache.find(path,
+                        follow_links=follow_links, workers=workers)]
+                    assert found == [path], 'Found %r' % found
+
+    def test_node_find_prune(self):
+        cache = cachefs.CacheFs(cache_expiry=2.0, stat_expiry=1.0)
+        seen = []
+        def prune(node):
+            seen.append(node.abs_path)
+            return node.base_name == 'subdir'
+
+        for workers in (None, 4):
+            del seen[:]
+            found = set([n.abs_path for n in cache.find(
+                self.temp_dir.tempdir, prune=prune, workers=workers)])
+            assert seen == [self.temp_dir.dir_subdir], \
+                    'Prune called for %r' % seen
+            assert self.temp_dir.dir_subdir in found, \
+                    'Pruned directory not reported'
+            assert self.temp_dir.file_b not in found, \
+                    'Pruned directory was searched'
+            assert self.temp_dir.file_a in found, 'A file was missed'
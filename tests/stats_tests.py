@@ -0,0 +1,76 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Cached file-system utility library
+# (C) 2016 VRT Systems
+#
+# vim: set ts=4 sts=4 et tw=78 sw=4:
+
+import cachefs
+from cachefs.stats import Stats
+import os
+
+from .utils import TempDirTestCase, FilesTempdir
+
+class TestStats(TempDirTestCase):
+    def test_counters_and_histogram(self):
+        stats = Stats()
+        stats.incr('hits')
+        stats.incr('hits', 2)
+        stats.record('stat', 0.0000005)
+        stats.record('stat', 0.000003)
+        stats.record('stat', 1000.0)
+
+        snapshot = stats.snapshot()
+        assert snapshot['counters'] == {'hits': 3}, \
+                'Counters: %r' % snapshot['counters']
+        hist = snapshot['latency']['stat']
+        assert hist['count'] == 3
+        assert hist['max'] == 1000.0
+        buckets = dict((bound, count) for (bound, count) in hist['buckets'])
+        assert buckets[1e-6] == 1, 'Sub-microsecond call not counted'
+        assert buckets[4e-6] == 1, '3 microsecond call not counted'
+        assert buckets[None] == 1, 'Slow call not counted'
+
+        stats.reset()
+        snapshot = stats.snapshot()
+        assert snapshot['counters'] == {}, 'Counters not reset'
+        assert snapshot['latency'] == {}, 'Histograms not reset'
+
+    def test_cachefs_stats(self):
+        with FilesTempdir('x') as tree:
+            tempdir = tree.tempdir
+            file_x = tree.join('x')
+            created = cachefs.CacheFs.registry_stats.snapshot()['counters'] \
+                    .get('created', 0)
+            cache = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0)
+            cache[file_x]
+            cache[file_x]
+            try:
+                cache[os.path.join(tempdir, 'missing')]
+                assert False, 'We got a file that does not exist'
+            except KeyError:
+                pass
+            list(cache[tempdir])
+
+            snapshot = cache.stats.snapshot()
+            counters = snapshot['counters']
+            assert counters['hits'] == 1, 'Counters: %r' % counters
+            assert counters['misses'] == 3, 'Counters: %r' % counters
+            assert counters['not_found'] == 1, 'Counters: %r' % counters
+            assert snapshot['latency']['stat']['count'] >= 3, \
+                    'Calls to lstat not timed'
+            assert snapshot['latency']['children']['count'] == 1, \
+                    'Listing not timed'
+
+            registry = cachefs.CacheFs.registry_stats.snapshot()
+            assert registry['counters']['created'] >= created + 3, \
+                    'Nodes created not counted'
+            assert registry['latency']['stat']['count'] >= 3, \
+                    'Process-wide calls to lstat not timed'
+
+            cache.stats.reset()
+            cache._cache_expiry = 0.0
+            cache._purge()
+            counters = cache.stats.snapshot()['counters']
+            assert counters['purges'] == 1, 'Counters: %r' % counters
+            assert counters['purged'] == 2, 'Counters: %r' % counters
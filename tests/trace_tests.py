@@ -0,0 +1,89 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Cached file-system utility library
+# (C) 2016 VRT Systems
+#
+# vim: set ts=4 sts=4 et tw=78 sw=4:
+
+from nose.plugins.skip import SkipTest
+import cachefs
+from cachefs import trace
+import os
+
+from .utils import TempDirTestCase, FilesTempdir
+
+
+class RecordingTracer(trace.Tracer):
+    def __init__(self):
+        self.before_calls = []
+        self.after_calls = []
+
+    def before(self, op, path, cache):
+        self.before_calls.append((op, path, cache))
+
+    def after(self, op, path, cache, elapsed, error):
+        self.after_calls.append((op, path, cache, elapsed, error))
+
+
+class TestTrace(TempDirTestCase):
+    def test_tracer_typeerror(self):
+        try:
+            cachefs.CacheFs(cache_expiry=2.0, stat_expiry=1.0,
+                    tracer='bogga')
+            assert False, 'It accepted a string'
+        except TypeError:
+            pass
+
+    def test_cache_tracer(self):
+        if not hasattr(os, 'symlink'):
+            raise SkipTest
+        with FilesTempdir('x') as tree:
+            tempdir = tree.tempdir
+            file_x = tree.join('x')
+            link_y = tree.join('y')
+            os.symlink('x', link_y)
+            tracer = RecordingTracer()
+            cache = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=60.0,
+                    tracer=tracer)
+            cache[file_x].stat
+            list(cache[tempdir])
+            cache[link_y].target
+            try:
+                cache[os.path.join(tempdir, 'missing')]
+            except KeyError:
+                pass
+
+            ops = [(op, path) for (op, path, c, elapsed, error)
+                    in tracer.after_calls]
+            for call in (('stat', file_x), ('children', tempdir),
+                    ('target', link_y)):
+                assert call in ops, '%r not traced in %r' % (call, ops)
+            assert [call[:3] for call in tracer.after_calls] \
+                    == tracer.before_calls, 'Calls not paired'
+
+            for (op, path, c, elapsed, error) in tracer.after_calls:
+                assert c is cache, 'Wrong cache given'
+                assert elapsed >= 0.0
+                if path.endswith('missing'):
+                    assert isinstance(error, OSError), \
+                            'Error not reported: %r' % error
+                else:
+                    assert error is None, 'Unexpected error %r' % error
+
+    def test_global_tracer(self):
+        tracer = RecordingTracer()
+        trace.add_tracer(tracer)
+        try:
+            with FilesTempdir() as tree:
+                cache = cachefs.CacheFs(cache_expiry=60.0,
+                        stat_expiry=60.0)
+                cache[tree.tempdir]
+                assert ('stat', tree.tempdir, cache) \
+                        in tracer.before_calls, 'Call not traced'
+        finally:
+            trace.remove_tracer(tracer)
+
+        del tracer.before_calls[:]
+        cache = cachefs.CacheFs(cache_expiry=60.0, stat_expiry=0.0)
+        cache[self.temp_dir.tempdir].stat
+        assert tracer.before_calls == [], 'Removed tracer still called'
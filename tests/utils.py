@@ -7,7 +7,10 @@
 
 import errno
 import os
+import shutil
+import sys
 import tempfile
+import threading
 
 class SimpleTempdir(object):
     '''
@@ -134,3 +137,113 @@ def compare_walk(walk1, walk2):
 
         assert set(dirs1) == set(dirs2), 'Directories do not match'
         assert set(files1) == set(files2), 'Files do not match'
+
+
+class TreeTempdir(SimpleTempdir):
+    '''
+    Generate a synthetic directory tree for benchmarking: below the top-level
+    directory, each directory holds "files" files and "width" sub-directories,
+    down to "depth" levels.  Directories are named 'dN' and files 'fN'.
+    '''
+    def __init__(self, width=4, depth=3, files=8):
+        super(TreeTempdir, self).__init__()
+        self.width = width
+        self.depth = depth
+        self.files = files
+        self.all_dirs = []
+
+    def make(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.all_files.add(self.tempdir)
+        self.all_dirs.append(self.tempdir)
+        self.to_rmdir.append(self.tempdir)
+
+        level = [self.tempdir]
+        for depth in range(self.depth + 1):
+            next_level = []
+            for dir_name in level:
+                for n in range(self.files):
+                    file_name = os.path.join(dir_name, 'f%d' % n)
+                    open(file_name, 'w').write(file_name)
+                    self.all_files.add(file_name)
+                    self.to_unlink.append(file_name)
+
+                if depth == self.depth:
+                    continue
+
+                for n in range(self.width):
+                    subdir = os.path.join(dir_name, 'd%d' % n)
+                    os.mkdir(subdir)
+                    self.all_files.add(subdir)
+                    self.all_dirs.append(subdir)
+                    next_level.append(subdir)
+            level = next_level
+
+        # Deepest directories first, so each is empty when removed.
+        self.to_rmdir = list(reversed(self.all_dirs))
+
+
+class FilesTempdir(SimpleTempdir):
+    '''
+    Generate a directory holding the named (empty) files and sub-directories,
+    given relative to it (sub-directories with a trailing '/').  Everything
+    inside it is removed with it, including anything added since.  This may
+    be used as a context manager.
+    '''
+    def __init__(self, *names):
+        super(FilesTempdir, self).__init__()
+        self.names = names
+
+    def __enter__(self):
+        self.make()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.delete()
+
+    def join(self, *names):
+        return os.path.join(self.tempdir, *names)
+
+    def make(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.all_files.add(self.tempdir)
+        for name in self.names:
+            path = self.join(name)
+            if name.endswith('/'):
+                os.mkdir(path)
+            else:
+                open(path, 'w').close()
+            self.all_files.add(os.path.normpath(path))
+
+    def delete(self):
+        if (self.tempdir is not None) and os.path.isdir(self.tempdir):
+            shutil.rmtree(self.tempdir)
+
+
+def race(fn, threads=8):
+    '''
+    Call fn() from several threads at once, switching between threads as
+    often as possible to provoke any race.  Returns the results.
+    '''
+    start = threading.Event()
+    results = []
+    def run():
+        start.wait()
+        results.append(fn())
+    workers = [threading.Thread(target=run) for n in range(threads)]
+
+    interval = getattr(sys, 'getswitchinterval', lambda : None)()
+    if interval is not None:
+        sys.setswitchinterval(1e-6)
+    try:
+        for worker in workers:
+            worker.start()
+        start.set()
+        for worker in workers:
+            worker.join()
+    finally:
+        if interval is not None:
+            sys.setswitchinterval(interval)
+
+    assert len(results) == threads, 'A thread failed'
+    return results
@@ -0,0 +1,166 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Cached file-system utility library
+# (C) 2016 VRT Systems
+#
+# vim: set ts=4 sts=4 et tw=78 sw=4:
+
+from nose.plugins.skip import SkipTest
+import cachefs
+from cachefs import watcher
+import os
+import time
+
+from .utils import TempDirTestCase, FilesTempdir
+
+def wait_for(check, timeout=5.0):
+    '''
+    Wait for the watcher thread to catch up with our changes.
+    '''
+    deadline = time.time() + timeout
+    while not check():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+def ancestors(path):
+    '''
+    Return the paths the watcher watches for the nodes within path.
+    '''
+    return set(watcher._ancestors(path))
+
+def make_watcher():
+    try:
+        return watcher.InotifyWatcher()
+    except OSError:
+        # Host system doesn't support inotify.
+        raise SkipTest()
+
+class TestInotifyWatcher(TempDirTestCase):
+    def test_watcher_typeerror(self):
+        try:
+            cachefs.CacheFs(cache_expiry=2.0, stat_expiry=1.0,
+                    watcher='bogga')
+            assert False, 'It accepted a string'
+        except TypeError:
+            pass
+
+    def test_stat_invalidated(self):
+        w = make_watcher()
+        try:
+            cache = cachefs.CacheFs(cache_expiry=300.0, stat_expiry=300.0,
+                    watcher=w)
+            node = cache[self.temp_dir.file_a]
+            assert node._node._watched, 'Node not watched'
+
+            size_1 = node.stat.st_size
+            open(self.temp_dir.file_a,'a').write(' -- some data')
+
+            # The change should be seen without waiting for expiry.
+            assert wait_for(lambda : node.stat.st_size > size_1), \
+                    'Cached data not refreshed.'
+        finally:
+            w.close()
+
+    def test_children_invalidated(self):
+        child_file = os.path.join(self.temp_dir.tempdir, 'watched')
+        w = make_watcher()
+        try:
+            cache = cachefs.CacheFs(cache_expiry=300.0, stat_expiry=300.0,
+                    watcher=w)
+            node = cache[self.temp_dir.tempdir]
+            try:
+                assert 'watched' not in set(node)
+                open(child_file,'w').write('new file')
+                assert wait_for(lambda : 'watched' in set(node)), \
+                        'Cached data not refreshed.'
+            finally:
+                os.unlink(child_file)
+
+            assert wait_for(lambda : 'watched' not in set(node)), \
+                    'Cached data not refreshed.'
+        finally:
+            w.close()
+
+    def test_close_unwatches(self):
+        w = make_watcher()
+        cache = cachefs.CacheFs(cache_expiry=300.0, stat_expiry=300.0,
+                watcher=w)
+        node = cache[self.temp_dir.file_b]
+        assert node._node._watched, 'Node not watched'
+        w.close()
+        assert not node._node._watched, 'Node still watched'
+
+    def test_aliased_directory(self):
+        with FilesTempdir('real/', 'real/inner/', 'real/inner/f') as tree:
+            real_file = tree.join('real', 'inner', 'f')
+            alias_file = tree.join('alias', 'inner', 'f')
+            os.symlink('real', tree.join('alias'))
+            w = make_watcher()
+            try:
+                cache = cachefs.CacheFs(cache_expiry=300.0,
+                        stat_expiry=300.0, watcher=w)
+                # The same directory is watched through both paths.
+                alias_node = cache[alias_file]
+                real_node = cache[real_file]
+                assert alias_node._node._watched, 'Node not watched'
+                assert real_node._node._watched, 'Node not watched'
+                assert alias_node.stat.st_size == 0
+                assert real_node.stat.st_size == 0
+
+                open(real_file, 'a').write('data')
+                assert wait_for(lambda : alias_node.stat.st_size > 0), \
+                        'Node under the alias not refreshed.'
+                assert wait_for(lambda : real_node.stat.st_size > 0), \
+                        'Node under the real path not refreshed.'
+            finally:
+                w.close()
+
+    def test_discard_unwatches(self):
+        w = make_watcher()
+        try:
+            cache = cachefs.CacheFs(cache_expiry=300.0, stat_expiry=300.0,
+                    watcher=w, max_nodes=1)
+            node_dir = cache[self.temp_dir.dir_subdir]
+            assert set(w._path_wd) == ancestors(self.temp_dir.tempdir) \
+                    | set([self.temp_dir.dir_subdir])
+
+            # Evicting the directory drops its own watch, but not those of
+            # its ancestors, still needed by the file.
+            node_file = cache[self.temp_dir.file_a]
+            assert not node_dir._node._watched, 'Evicted node still watched'
+            assert node_file._node._watched, 'Node not watched'
+            assert set(w._path_wd) == ancestors(self.temp_dir.tempdir), \
+                    'Watches: %r' % w._path_wd
+
+            # Purging the rest drops every watch.
+            cache._cache_expiry = 0.0
+            cache._purge()
+            assert not node_file._node._watched, 'Purged node still watched'
+            assert w._path_wd == {}, 'Watches leaked: %r' % w._path_wd
+            assert w._wd_paths == {}, 'Watches leaked: %r' % w._wd_paths
+        finally:
+            w.close()
+
+    def test_ancestor_renamed(self):
+        with FilesTempdir('a/', 'a/b/', 'a/b/f') as tree:
+            w = make_watcher()
+            try:
+                cache = cachefs.CacheFs(cache_expiry=600.0,
+                        stat_expiry=600.0, watcher=w)
+                node = cache[tree.join('a', 'b', 'f')]
+                assert node._node._watched, 'Node not watched'
+                node.stat
+
+                # Renaming a directory two levels up moves the file away.
+                os.rename(tree.join('a'), tree.join('z'))
+                assert wait_for(lambda : not node._node._watched), \
+                        'Node still watched'
+                try:
+                    node.stat
+                    assert False, 'Stale statistics returned'
+                except OSError:
+                    pass
+            finally:
+                w.close()